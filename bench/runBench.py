@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Offline benchmark of the spots and maps jobs
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Runs getSpotsWindWaves.py and getWavesMaps.py stage by stage against
+# synthetic data (synthData.py) served by local stand-ins (standins.py):
+# no MOTU, ERDDAP or MySQL needed. Every run starts cold (empty download,
+# resample, index and frame caches). Stage figures come from instrument.py
+# and are stored in bench/results/<date>-<commit>.json; stages slower than
+# the previous results by more than REGRESSION are reported. Each run is a
+# separate process, so its peak RSS and imports are its own.
+#
+#   ./bench/runBench.py                       1k/10k/100k spots, 10/40/80 frames
+#   ./bench/runBench.py --spots 1000 --frames 10
+
+import os
+import sys
+import json
+import glob
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+# configured before the job modules, whose own basicConfig() is then a no-op
+LOGFILE = os.path.join(tempfile.gettempdir(), "copernicus-bench.log")
+logging.basicConfig(filename=LOGFILE, format='%(asctime)s - %(message)s', level=logging.WARN)
+
+import numpy as np
+import instrument
+import noaaWind
+import forecastCache
+import downloadCache
+import upstreamProbe
+import spotIndex
+import spotsDb
+import getSpotsWindWaves as spots
+import getWavesMaps as maps
+import synthData
+import standins
+
+
+# kept between runs for the comparison, outside the tree
+RESULTSDIR = os.path.join(tempfile.gettempdir(), "copernicus-bench-results")
+SPOTSIZES = (1000, 10000, 100000)
+FRAMES = (10, 40, 80)
+# forecast length of the spots runs, in frames (3-hour steps)
+SPOTFRAMES = 40
+# relative slowdown of a stage reported as a regression
+REGRESSION = 0.2
+# stages faster than this are too noisy to compare
+MINSECONDS = 0.05
+# bbox requested by the scripts
+BBOX = ('30', '-10', '46', '36.5')
+
+
+def failNotice(text):
+    raise RuntimeError("notice mail: " + text)
+
+
+def cleanDir(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    return directory + "/"
+
+
+def configure(workDir, motuClient, baseUrl):
+    # point every path and endpoint of the jobs into workDir
+    for module in (spots, maps):
+        module.MOTUCLIENT = motuClient
+        module.send_notice_mail = failNotice
+    noaaWind.ERDDAP = baseUrl + standins.ERDDAPPATH
+    downloadCache.CACHEDIR = workDir + "/downloads/"
+    downloadCache.MANIFEST = downloadCache.CACHEDIR + "manifest.json"
+    upstreamProbe.PROBEFILE = downloadCache.CACHEDIR + "probe.json"
+    forecastCache.CACHEDIR = workDir + "/resampled/"
+    spotIndex.CACHEDIR = workDir + "/index/"
+    spotsDb.SNAPSHOTFILE = workDir + "/index/spots.json"
+
+    spots.path = workDir + "/spots"
+    spots.NOAA_FILE = workDir + "/noaa/noaaWind.nc"
+    spots.FORECAST_FILEPATH = workDir + "/spots/CMEMS-NOAA/"
+    spots.DIGESTFILE = workDir + "/spots/spotDigests.json"
+    spots.CHANGEDFILE = workDir + "/spots/changed.txt"
+    spots.FORECASTSTORE = workDir + "/spots/CMEMS-NOAA.store/"
+
+    maps.path = workDir + "/maps"
+    maps.TEMPDIR = maps.path + "/CMEMSmaps.new/"
+    maps.TILETEMPDIR = maps.path + "/CMEMStiles.new/"
+    # the relief background is kept across runs, as in production
+    maps.CACHEDIR = workDir + "/background/"
+    maps.FRAMECACHEDIR = workDir + "/frames/"
+
+
+def coldStart(workDir):
+    for name in ("downloads", "resampled", "index", "noaa", "spots", "maps", "frames"):
+        cleanDir(workDir + "/" + name)
+    os.makedirs(spots.FORECAST_FILEPATH)
+    spots.windValid = True
+
+
+def cmemsFile(workDir, frames):
+    # synthetic CMEMS download covering frames 3-hour steps from today
+    ncfile = workDir + "/data/cmems-%d.nc" % frames
+    if not os.path.isfile(ncfile):
+        os.makedirs(workDir + "/data", exist_ok=True)
+        start = np.datetime64(datetime.utcnow().date())
+        synthData.makeCMEMS(ncfile + ".part", start, frames * 3)
+        os.replace(ncfile + ".part", ncfile)
+    return ncfile
+
+
+def runStages(job, stages):
+    # run the stages, return their instrument records
+    first = len(instrument.records)
+    for name, stage in stages:
+        if stage() is False:
+            raise RuntimeError(job + ": " + name + " failed, see " + LOGFILE)
+    return instrument.records[first:]
+
+
+def benchSpots(workDir, count):
+    coldStart(workDir)
+    dbfile = standins.makeSpotsDb(workDir + "/index/spots.db", synthData.seaSpots(count))
+    spotsDb.closeConnection()
+    spotsDb.connectionFactory = lambda: spotsDb.sqlite3.connect(dbfile, check_same_thread=False)
+    state = {}
+    return runStages("spots", (
+        ("todayProductionUpdate", spots.todayProductionUpdate),
+        ("getNCFiles", lambda: spots.getNCFiles(*BBOX)),
+        ("readData", lambda: state.update(dbData=spots.readData())),
+        ("updateSpots", lambda: spots.updateSpots(state['dbData']))))
+
+
+def benchMaps(workDir):
+    coldStart(workDir)
+    return runStages("maps", (
+        ("todayProductionUpdate", maps.todayProductionUpdate),
+        ("getNCFiles", lambda: maps.getNCFiles(*BBOX)),
+        ("updateMaps", maps.updateMaps)))
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', '-C', BENCHDIR, 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def runKey(run):
+    return (run['job'], run['spots'], run['frames'])
+
+
+def compareResults(previous, current):
+    # stage -> (previous, current) wall time of the slower stages
+    before = {}
+    for run in previous['runs']:
+        for record in run['records']:
+            before[runKey(run) + (record['stage'],)] = record['wall']
+    slower = []
+    for run in current['runs']:
+        for record in run['records']:
+            key = runKey(run) + (record['stage'],)
+            if key not in before or max(before[key], record['wall']) < MINSECONDS:
+                continue
+            if record['wall'] > before[key] * (1 + REGRESSION):
+                slower.append((key, before[key], record['wall']))
+    return slower
+
+
+def runOne(workDir, job, count, frames, baseUrl, outfile):
+    # one run in this process; its records are written to outfile
+    endDate = (datetime.utcnow().date() + timedelta(days=9)).isoformat()
+    configure(workDir, standins.writeMotuClient(workDir + "/motuclient", baseUrl, endDate), baseUrl)
+    records = benchSpots(workDir, count) if job == 'spots' else benchMaps(workDir)
+    with open(outfile, 'w') as f:
+        json.dump(records, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the spots and maps jobs")
+    parser.add_argument('--spots', default=",".join(str(n) for n in SPOTSIZES),
+                        help="comma separated spot counts (empty: none)")
+    parser.add_argument('--frames', default=",".join(str(n) for n in FRAMES),
+                        help="comma separated map frame counts (empty: none)")
+    parser.add_argument('--workdir', help="scratch directory (default: a temporary one)")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    parser.add_argument('--results', default=RESULTSDIR,
+                        help="directory of the results, compared with the last one (default: %(default)s)")
+    # internal: one run, spawned by the main process
+    parser.add_argument('--run', nargs=5, metavar=('JOB', 'SPOTS', 'FRAMES', 'URL', 'OUTFILE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    workDir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="copernicus-bench-"))
+    os.makedirs(workDir, exist_ok=True)
+    if args.run:
+        job, count, frames, baseUrl, outfile = args.run
+        runOne(workDir, job, int(count), int(frames), baseUrl, outfile)
+        return 0
+
+    spotSizes = [int(n) for n in args.spots.split(",") if n]
+    frameSizes = [int(n) for n in args.frames.split(",") if n]
+    noaaLast = (datetime.utcnow().date() + timedelta(days=6)).isoformat() + "T12:00:00Z"
+    server, baseUrl = standins.startServer(None, noaaLast, workDir)
+
+    results = {'commit': gitCommit(), 'date': datetime.now().isoformat(timespec='seconds'),
+               'host': platform.node(), 'python': platform.python_version(),
+               'cpus': os.cpu_count(), 'mapWorkers': maps.MAPWORKERS, 'runs': []}
+    plan = [('spots', n, SPOTFRAMES) for n in spotSizes] + [('maps', 0, n) for n in frameSizes]
+    try:
+        for job, count, frames in plan:
+            server.cmemsFile = cmemsFile(workDir, frames)
+            print("%s: %d spots, %d frames" % (job, count, frames), flush=True)
+            outfile = workDir + "/records.json"
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--workdir', workDir,
+                                   '--run', job, str(count), str(frames), baseUrl, outfile])
+            with open(outfile) as f:
+                records = json.load(f)
+            results['runs'].append({'job': job, 'spots': count, 'frames': frames, 'records': records})
+            for record in records:
+                print("  %-28s %8.3f s  cpu %8.3f s  %7.1f MB" % (
+                    record['stage'], record['wall'], record['cpu'], record['peakRSS']))
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    resultsDir = os.path.abspath(args.results)
+    previous = sorted(glob.glob(os.path.join(resultsDir, "*.json")))
+    os.makedirs(resultsDir, exist_ok=True)
+    resultFile = resultsDir + "/" + datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + results['commit'] + ".json"
+    with open(resultFile, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print("Results: " + resultFile)
+
+    if previous:
+        with open(previous[-1]) as f:
+            slower = compareResults(json.load(f), results)
+        print("Compared with " + os.path.basename(previous[-1]) + ": " +
+              ("%d slower stages" % len(slower) if slower else "no regressions"))
+        for (job, count, frames, stage), before, now in slower:
+            print("  %s %d spots %d frames %s: %.3f s -> %.3f s" % (job, count, frames, stage, before, now))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Local stand-ins for MOTU, ERDDAP and the spots database
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# startServer() runs an HTTP server on 127.0.0.1 answering
+#   /motu/cmems.nc?x=&X=&y=&Y=&t=&T=&v=     the subset of the CMEMS file of
+#                                           the run, as MOTU extracts it
+#   /erddap/griddap/NCEP_Global_Best.json   time[last]
+#   /erddap/griddap/NCEP_Global_Best.nc?... griddap subsets, generated
+# writeMotuClient() writes an executable answering like motuclient does
+# to the two commands the scripts run (coverage, download url); FAILFILE
+# in its directory lists pieces (the -x -t values) to fail once, to
+# exercise the retries of motuPlanner.py.
+# makeSpotsDb() writes a SQLite spots/service database for spotsDb.
+
+import os
+import re
+import sys
+import sqlite3
+import tempfile
+import threading
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import netCDF4
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK as NCLOCK
+import synthData
+
+
+ERDDAPPATH = "/erddap/griddap/NCEP_Global_Best"
+FAILFILE = "motufail.txt"
+CONSTRAINT = re.compile(r"\[\((.*?)\):1:\((.*?)\)\]\[\((.*?)\):1:\((.*?)\)\]\[\((.*?)\):1:\((.*?)\)\]")
+
+
+def subsetCMEMS(src, outfile, query):
+    # cells within [x, X] x [y, Y], hours of the days t..T, variables v:
+    # the layout, attributes and packed values of src
+    with netCDF4.Dataset(src) as nc, netCDF4.Dataset(outfile, 'w', format=nc.data_model) as out:
+        nc.set_auto_maskandscale(False)
+        times = nc.variables['time']
+        first = datetime.strptime(query['t'][0], "%Y-%m-%d")
+        last = datetime.strptime(query['T'][0], "%Y-%m-%d") + timedelta(hours=23)
+        bounds = {'time': netCDF4.date2num([first, last], times.units, times.calendar),
+                  'longitude': (float(query['x'][0]), float(query['X'][0])),
+                  'latitude': (float(query['y'][0]), float(query['Y'][0]))}
+        index = {}
+        for name, (low, high) in bounds.items():
+            values = np.asarray(nc.variables[name][:])
+            inside = np.nonzero((values >= low - 1e-6) & (values <= high + 1e-6))[0]
+            index[name] = slice(int(inside[0]), int(inside[-1]) + 1) if inside.size else slice(0, 0)
+        out.setncatts({k: nc.getncattr(k) for k in nc.ncattrs()})
+        for name, dim in nc.dimensions.items():
+            length = len(range(*index[name].indices(len(dim)))) if name in index else len(dim)
+            out.createDimension(name, None if dim.isunlimited() else length)
+        for name, var in nc.variables.items():
+            if name not in nc.dimensions and name not in query['v']:
+                continue
+            fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+            dst = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+            dst.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+            dst.set_auto_maskandscale(False)
+            data = var[tuple(index.get(d, slice(None)) for d in var.dimensions)]
+            if data.size:
+                dst[tuple(slice(0, n) for n in data.shape)] = data
+    return outfile
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendFile(self, filename, contentType):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(os.path.getsize(filename)))
+        self.end_headers()
+        with open(filename, 'rb') as f:
+            while True:
+                block = f.read(1 << 20)
+                if not block:
+                    break
+                self.wfile.write(block)
+
+    def sendBytes(self, data, contentType):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.unquote(url.query)
+        if url.path == "/motu/cmems.nc" and not url.query:
+            self.sendFile(self.server.cmemsFile, 'application/x-netcdf')
+        elif url.path == "/motu/cmems.nc":
+            fd, ncfile = tempfile.mkstemp(suffix=".nc", dir=self.server.workDir)
+            os.close(fd)
+            try:
+                # netCDF4 calls of the handler threads one at a time
+                with NCLOCK:
+                    subsetCMEMS(self.server.cmemsFile, ncfile, urllib.parse.parse_qs(url.query))
+                self.sendFile(ncfile, 'application/x-netcdf')
+            finally:
+                os.remove(ncfile)
+        elif url.path == ERDDAPPATH + ".json":
+            data = '{"table":{"columnNames":["time"],"rows":[["%s"]]}}' % self.server.noaaLast
+            self.sendBytes(data.encode(), 'application/json')
+        elif url.path == ERDDAPPATH + ".nc" and CONSTRAINT.search(query):
+            start, end, minLat, maxLat, lon0, lon1 = CONSTRAINT.search(query).groups()
+            fd, ncfile = tempfile.mkstemp(suffix=".nc", dir=self.server.workDir)
+            os.close(fd)
+            try:
+                with NCLOCK:
+                    synthData.makeNOAA(ncfile, start, end, float(minLat), float(maxLat),
+                                       float(lon0), float(lon1), seed=self.server.seed)
+                self.sendFile(ncfile, 'application/x-netcdf')
+            finally:
+                os.remove(ncfile)
+        else:
+            self.send_error(404)
+
+
+def startServer(cmemsFile, noaaLast, workDir, seed=0):
+    # serve in a daemon thread; returns (server, base url)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.cmemsFile = cmemsFile
+    server.noaaLast = noaaLast
+    server.workDir = workDir
+    server.seed = seed
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, "http://127.0.0.1:%d" % server.server_address[1])
+
+
+def writeMotuClient(outfile, baseUrl, endDate):
+    # coverage request (-D): the timeCoverage line; otherwise: the url of
+    # the extraction, its options in the query
+    script = '''#!%s
+import os
+import sys
+import urllib.parse
+if '-D' in sys.argv:
+    print('<timeCoverage msg="OK" start="2019-01-01T00:00:00Z" end="%sT23:00:00Z"/>')
+    sys.exit()
+args = sys.argv[1:]
+query = [(a[1:], b) for a, b in zip(args, args[1:]) if a in ('-x', '-X', '-y', '-Y', '-t', '-T', '-v')]
+failfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), %r)
+piece = dict(query)['x'] + ' ' + dict(query)['t']
+if os.path.isfile(failfile):
+    pieces = open(failfile).read().splitlines()
+    if piece in pieces:
+        pieces.remove(piece)
+        open(failfile, 'w').write(''.join(p + '\\n' for p in pieces))
+        print('Error: 010-6 [Excp] Execution failed')
+        sys.exit(1)
+print('[INFO] Asynchronous mode set')
+print('%s/motu/cmems.nc?' + urllib.parse.urlencode(query))
+''' % (sys.executable, endDate, FAILFILE, baseUrl)
+    with open(outfile, 'w') as f:
+        f.write(script)
+    os.chmod(outfile, 0o755)
+    return outfile
+
+
+def makeSpotsDb(dbfile, spots, updatedOn='2000-01-01'):
+    ids, lats, lons = spots
+    if os.path.isfile(dbfile):
+        os.remove(dbfile)
+    db = sqlite3.connect(dbfile)
+    db.execute("CREATE TABLE spots (name TEXT, country TEXT, type TEXT, lon REAL, lat REAL, id INTEGER)")
+    db.execute("CREATE TABLE service (updatedOn TEXT)")
+    db.executemany("INSERT INTO spots VALUES ('spot', 'xx', 'surf', ?, ?, ?)",
+                   zip(lons.tolist(), lats.tolist(), ids))
+    db.execute("INSERT INTO service VALUES (?)", (updatedOn,))
+    db.commit()
+    db.close()
+    return dbfile
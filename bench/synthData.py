@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Synthetic CMEMS and NOAA data for the offline benchmarks
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# CMEMS files have the MEDSEA_ANALYSIS_FORECAST_WAV_006_017 grid (1/24
+# degree, cut to the -10..36.5 / 30..46 bbox the scripts request), an hourly
+# time axis and VHM0, VMDR, VTM10 stored as scaled int16 with land as fill
+# values, as the MOTU subsets are. NOAA files have the NCEP_Global_Best 0.5
+# degree grid on 0..359.5 longitudes with ugrd10m, vgrd10m every 3 hours.
+# Fields are smooth and moving in time; everything is seeded.
+
+import numpy as np
+import netCDF4
+
+
+# MEDSEA wave grid
+LAT0 = 30.1875
+LON0 = -18.125
+STEP = 1. / 24
+NLAT = 380
+NLON = 1307
+FILLVALUE = -32767
+
+
+def medseaAxes(minLon=-10., maxLon=36.5):
+    lats = LAT0 + np.arange(NLAT) * STEP
+    lons = LON0 + np.arange(NLON) * STEP
+    lons = lons[(lons >= minLon - 1e-9) & (lons <= maxLon + 1e-9)]
+    return (lats, lons)
+
+
+def seaMask(lats, lons, seed=0):
+    # True on sea: a few smooth "continents" on a mostly sea domain
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(lats, lons, indexing='ij')
+    land = np.zeros(y.shape)
+    for k in range(12):
+        cy, cx = rng.uniform(lats[0], lats[-1]), rng.uniform(lons[0], lons[-1])
+        r = rng.uniform(0.8, 3.)
+        land += np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (r * r))
+    return land < 0.5
+
+
+def waveFields(lats, lons, hours, seed=0):
+    # (VHM0, VMDR, VTM10) at the given hours since the start
+    rng = np.random.default_rng(seed)
+    phase = rng.uniform(0, 2 * np.pi, 4)
+    y = lats[np.newaxis, :, np.newaxis]
+    x = lons[np.newaxis, np.newaxis, :]
+    t = np.asarray(hours, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    a = np.sin(x / 5. + t / 17. + phase[0]) * np.cos(y / 3. - t / 23. + phase[1])
+    b = np.sin(x / 2.3 - t / 11. + phase[2]) * np.sin(y / 1.7 + phase[3])
+    height = 0.05 + 1.1 * (1.4 + a + 0.4 * b)
+    direction = np.mod(180. + 170. * a + 60. * b + t, 360.)
+    period = 3. + 2. * (1.2 + a) + 0.5 * b
+    return (height, direction, period)
+
+
+def makeCMEMS(outfile, start, hours, minLon=-10., maxLon=36.5, seed=0, blockHours=6):
+    # hourly file starting at start (numpy datetime64), written in blocks
+    lats, lons = medseaAxes(minLon, maxLon)
+    sea = seaMask(lats, lons, seed)
+    start = np.datetime64(start, 's')
+    with netCDF4.Dataset(outfile, 'w') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('latitude', lats.size)
+        nc.createDimension('longitude', lons.size)
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = "hours since 1950-01-01 00:00:00"
+        time.calendar = "gregorian"
+        nc.createVariable('latitude', 'f4', ('latitude',))[:] = lats
+        nc.createVariable('longitude', 'f4', ('longitude',))[:] = lons
+        variables = []
+        # i2 holds +-327.67 at 0.01: directions (0-360) are offset by 180
+        for name, scale, offset in (('VHM0', 0.01, 0.), ('VMDR', 0.01, 180.), ('VTM10', 0.01, 0.)):
+            var = nc.createVariable(name, 'i2', ('time', 'latitude', 'longitude'),
+                                    fill_value=FILLVALUE, zlib=False)
+            var.scale_factor = np.float32(scale)
+            var.add_offset = np.float32(offset)
+            variables.append(var)
+
+        origin = np.datetime64('1950-01-01T00:00:00', 's')
+        first = (start - origin) / np.timedelta64(1, 'h')
+        for h0 in range(0, hours, blockHours):
+            h = np.arange(h0, min(h0 + blockHours, hours))
+            time[h0:h0 + h.size] = first + h
+            for var, field in zip(variables, waveFields(lats, lons, h, seed)):
+                var[h0:h0 + h.size] = np.ma.masked_array(field, np.broadcast_to(~sea, field.shape))
+    return outfile
+
+
+def noaaAxes(minLat, maxLat, lon0, lon1):
+    lats = np.arange(-90., 90.5, 0.5)
+    lons = np.arange(0., 360., 0.5)
+    lats = lats[(lats >= minLat - 1e-9) & (lats <= maxLat + 1e-9)]
+    lons = lons[(lons >= lon0 - 1e-9) & (lons <= lon1 + 1e-9)]
+    return (lats, lons)
+
+
+def makeNOAA(outfile, startTime, endTime, minLat, maxLat, lon0, lon1, seed=0):
+    # an ERDDAP griddap answer: steps every 3 hours in [startTime, endTime]
+    lats, lons = noaaAxes(minLat, maxLat, lon0, lon1)
+    start = np.datetime64(startTime.rstrip('Z'), 'h')
+    end = np.datetime64(endTime.rstrip('Z'), 'h')
+    first = start + (-start.astype(np.int64)) % 3
+    times = np.arange(first, end + 1, 3)
+    hours = times.astype(np.int64).astype(np.float64)
+    rng = np.random.default_rng(seed)
+    phase = rng.uniform(0, 2 * np.pi, 2)
+    y = lats[np.newaxis, :, np.newaxis]
+    x = lons[np.newaxis, np.newaxis, :]
+    t = hours[:, np.newaxis, np.newaxis]
+    u = 8. * np.sin(x / 7. + t / 19. + phase[0]) * np.cos(y / 5.)
+    v = 6. * np.cos(x / 4. - t / 13. + phase[1]) * np.sin(y / 6.)
+    with netCDF4.Dataset(outfile, 'w') as nc:
+        nc.createDimension('time', times.size)
+        nc.createDimension('latitude', lats.size)
+        nc.createDimension('longitude', lons.size)
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = "seconds since 1970-01-01T00:00:00Z"
+        time[:] = hours * 3600.
+        nc.createVariable('latitude', 'f4', ('latitude',))[:] = lats
+        nc.createVariable('longitude', 'f4', ('longitude',))[:] = lons
+        nc.createVariable('ugrd10m', 'f4', ('time', 'latitude', 'longitude'))[:] = u
+        nc.createVariable('vgrd10m', 'f4', ('time', 'latitude', 'longitude'))[:] = v
+    return outfile
+
+
+def seaSpots(count, minLon=-10., maxLon=36.5, seed=0):
+    # (ids, lats, lons) of count spots on sea cells of the synthetic grid
+    lats, lons = medseaAxes(minLon, maxLon)
+    sea = np.argwhere(seaMask(lats, lons, seed))
+    rng = np.random.default_rng(seed + 1)
+    cells = sea[rng.integers(0, len(sea), count)]
+    jitter = rng.uniform(-STEP / 3, STEP / 3, (count, 2))
+    return (list(range(1, count + 1)), lats[cells[:, 0]] + jitter[:, 0], lons[cells[:, 1]] + jitter[:, 1])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Content-validated cache of downloaded NC files, shared by both scripts
+#
+#  (C) Copyright 2019-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Every download is recorded in a manifest with its request parameters
+# (service, bbox, date range, variables), size and checksum. A request
+# already satisfied by a valid cached file is not downloaded again. Files
+# are written under a temporary name and renamed into place.
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+import downloads
+import forecastCache
+
+
+CACHEDIR = "/tmp/CMEMSdownloads/"
+MANIFEST = CACHEDIR + "manifest.json"
+# cached files older than this are removed
+CACHEDAYS = 2
+
+
+def requestParams(service, minLat, minLon, maxLat, maxLon, startDate, endDate, variables):
+    return {'service': service,
+            'bbox': [float(minLon), float(minLat), float(maxLon), float(maxLat)],
+            'start': startDate, 'end': endDate,
+            'variables': sorted(variables)}
+
+
+def requestKey(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+@contextmanager
+def manifestLock():
+    os.makedirs(CACHEDIR, exist_ok=True)
+    with open(CACHEDIR + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def readManifest():
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+def writeManifest(manifest):
+    tmpfile = MANIFEST + "." + str(os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmpfile, MANIFEST)
+
+
+def isValid(entry):
+    # the file is still there, with the recorded size and content
+    try:
+        if os.path.getsize(entry['file']) != entry['size']:
+            return False
+    except OSError:
+        return False
+    return forecastCache.fileChecksum(entry['file']) == entry['checksum']
+
+
+def covers(entry, params):
+    # same service, bbox and start, at least the variables and end date
+    have = entry['params']
+    return (have['service'] == params['service'] and have['bbox'] == params['bbox'] and
+            have['start'] == params['start'] and have['end'] >= params['end'] and
+            set(have['variables']) >= set(params['variables']))
+
+
+def lookup(params):
+    # path of a valid cached file satisfying the request, or None;
+    # an exact match is preferred over a superset request
+    manifest = readManifest()
+    key = requestKey(params)
+    candidates = [manifest[key]] if key in manifest else []
+    candidates += [e for k, e in sorted(manifest.items()) if k != key and covers(e, params)]
+    for entry in candidates:
+        if isValid(entry):
+            return entry['file']
+        logging.warning("Cached download is not valid anymore: " + entry['file'])
+    return None
+
+
+def checksumOf(ncfile):
+    # recorded checksum of a cached file, so it is not hashed twice
+    for entry in readManifest().values():
+        if entry['file'] == ncfile:
+            return entry['checksum']
+    return None
+
+
+def prune(manifest):
+    limit = time.time() - CACHEDAYS * 86400
+    for key, entry in list(manifest.items()):
+        if entry['created'] < limit or not os.path.isfile(entry['file']):
+            if os.path.isfile(entry['file']):
+                os.remove(entry['file'])
+            del manifest[key]
+
+
+def cacheFile(params):
+    # where the file of the request is kept
+    os.makedirs(CACHEDIR, exist_ok=True)
+    return CACHEDIR + requestKey(params) + ".nc"
+
+
+def record(params, ncfile):
+    # add the complete file of the request to the manifest
+    entry = {'params': params, 'file': ncfile, 'size': os.path.getsize(ncfile),
+             'checksum': forecastCache.fileChecksum(ncfile), 'created': time.time()}
+    with manifestLock():
+        manifest = readManifest()
+        manifest[requestKey(params)] = entry
+        prune(manifest)
+        writeManifest(manifest)
+    return ncfile
+
+
+def download(params, url, name):
+    # fetch url for the request and record it in the manifest; returns the
+    # cached file path and raises HTTPError/URLError as urlopen does
+    ncfile = cacheFile(params)
+    downloads.fetch(url, ncfile, name)
+    return record(params, ncfile)
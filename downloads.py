@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Streaming HTTP downloads with resume, progress and throughput logging
+#
+#  (C) Copyright 2018-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Transfers stream into <outfile>.part with large buffers and are renamed
+# into place when complete. A transfer dropped partway is resumed with an
+# HTTP Range request. Independent sources are fetched in parallel threads.
+
+import os
+import time
+import socket
+import logging
+import http.client
+import urllib.request
+from urllib.error import URLError, HTTPError
+from concurrent.futures import ThreadPoolExecutor
+import instrument
+
+
+BUFSIZE = 1 << 20
+# attempts after a dropped transfer before giving up
+RETRIES = 3
+# seconds between progress log lines
+PROGRESS = 15
+TIMEOUT = 120
+
+
+def rate(nbytes, seconds):
+    return "%.1f MB in %.1f s (%.2f MB/s)" % (nbytes / 1e6, seconds, nbytes / 1e6 / max(seconds, 1e-6))
+
+
+def fetch(url, outfile, name=None, bufsize=BUFSIZE, retries=RETRIES):
+    # download url to outfile; returns {'name', 'bytes', 'seconds', 'rate'}
+    # and raises HTTPError/URLError as urlopen does
+    name = name or os.path.basename(outfile)
+    partfile = outfile + ".part"
+    if os.path.isfile(partfile):
+        os.remove(partfile)
+
+    start = time.time()
+    attempt = 0
+    while True:
+        have = os.path.getsize(partfile) if os.path.isfile(partfile) else 0
+        request = urllib.request.Request(url)
+        if have:
+            request.add_header('Range', 'bytes=%d-' % have)
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                if have and response.status != 206:
+                    # server ignored the range: start over
+                    have = 0
+                length = response.getheader('Content-Length')
+                expected = have + int(length) if length else None
+                received = have
+                lastLog = time.time()
+                with open(partfile, 'ab' if have else 'wb') as out_file:
+                    while True:
+                        block = response.read(bufsize)
+                        if not block:
+                            break
+                        out_file.write(block)
+                        received += len(block)
+                        if time.time() - lastLog >= PROGRESS:
+                            lastLog = time.time()
+                            logging.warning(name + ": " + rate(received, lastLog - start))
+            if expected is not None and received < expected:
+                raise http.client.IncompleteRead(b'', expected - received)
+            break
+        except HTTPError as e:
+            if e.code < 500:
+                raise
+            error = e
+        except (URLError, http.client.HTTPException, ConnectionError, socket.timeout) as e:
+            error = e
+        attempt += 1
+        if attempt > retries:
+            if isinstance(error, URLError):
+                raise error
+            raise URLError(error)
+        logging.warning(name + ": transfer interrupted (" + str(error) + "), resuming")
+
+    os.replace(partfile, outfile)
+    seconds = time.time() - start
+    size = os.path.getsize(outfile)
+    instrument.countBytes(size)
+    logging.warning(name + ": downloaded " + rate(size, seconds))
+    return {'name': name, 'bytes': size, 'seconds': seconds, 'rate': size / max(seconds, 1e-6)}
+
+
+def runParallel(tasks):
+    # run the callables concurrently, return their results in order;
+    # the first exception raised by a task is re-raised
+    with ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def fetchAll(jobs, bufsize=BUFSIZE):
+    # jobs: list of (url, outfile, name)
+    return runParallel([lambda job=job: fetch(job[0], job[1], job[2], bufsize) for job in jobs])
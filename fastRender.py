@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Direct NumPy rasterizer for the waves maps
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# For a fixed grid and output size everything matplotlib/Basemap compute per
+# frame is precomputed once: the pixel -> grid cell lookup of the Mercator
+# map box, a 256-entry color LUT for the LogNorm scale and pre-rendered arrow
+# sprites. A frame is then one gather plus LUT indexing over the cached
+# background, arrows stamped on top, encoded straight to JPEG.
+# The geometry is built by getWavesMaps.initFastRenderer(). For sea-cell
+# data (see seaGrid.py) pixels are looked up straight into the sea cells and
+# only those are colored.
+
+import numpy as np
+from PIL import Image
+import spotsExtract
+import seaGrid
+
+
+# arrow directions are drawn from this many pre-rendered sprites
+ARROWANGLES = 72
+
+
+def axisLookup(axis, coords):
+    # nearest grid index for every pixel coordinate, -1 outside the grid
+    idx = spotsExtract.nearestIndex(axis, coords)
+    half = abs(float(axis[-1]) - float(axis[0])) / max(len(axis) - 1, 1) / 2
+    outside = np.abs(np.asarray(axis, dtype=np.float64)[idx] - coords) > half + 1e-9
+    idx[outside] = -1
+    return idx
+
+
+def colorLevels(values, vmin, vmax, n=256):
+    # LUT index of every value as LogNorm(vmin, vmax, clip=True) and an
+    # n-color colormap would pick it; n marks no-data (NaN, <= 0)
+    levels = np.full(values.shape, n, dtype=np.uint16)
+    valid = values > 0
+    norm = (np.log(np.clip(values[valid], vmin, vmax)) - np.log(vmin)) / (np.log(vmax) - np.log(vmin))
+    levels[valid] = np.minimum((norm * n).astype(np.intp), n - 1)
+    return levels
+
+
+def buildRenderer(lons, lats, colLons, rowLats, box, background, lutColors,
+                  vmin, vmax, arrowPixels, sprites, cells=None):
+    # lons, lats: grid axes; colLons, rowLats: coordinates of the pixel
+    # columns/rows inside box = (left, top, right, bottom) of the background;
+    # lutColors: (256, 3) uint8; arrowPixels: (col, row) of every arrow tail
+    # with their grid (y, x) cells; sprites: (ARROWANGLES, h, w, 4) uint8;
+    # cells: seaGrid.cellIndex() of sea-cell data
+    lut = np.zeros((len(lutColors) + 1, 3), dtype=np.uint8)
+    lut[:-1] = lutColors
+    state = {'cols': axisLookup(lons, colLons), 'rows': axisLookup(lats, rowLats),
+             'box': box, 'background': np.ascontiguousarray(background[:, :, :3]),
+             'lut': lut, 'vmin': vmin, 'vmax': vmax,
+             'arrowPixels': arrowPixels, 'sprites': sprites, 'cells': cells, 'pixelCells': None}
+    if cells is not None:
+        # sea cell of every pixel, -1 on land and outside the grid
+        cells = np.pad(cells, ((0, 1), (0, 1)), constant_values=-1)
+        state['pixelCells'] = cells[state['rows'][:, np.newaxis], state['cols'][np.newaxis, :]]
+    return state
+
+
+def rasterize(state, waveH):
+    # background with the wave layer composited in the map box
+    rows = state['rows']
+    cols = state['cols']
+    n = len(state['lut']) - 1
+    levels = colorLevels(np.asarray(waveH), state['vmin'], state['vmax'], n)
+    # pixels outside the grid (and on land) read the no-data level
+    if state['pixelCells'] is not None:
+        pixels = np.append(levels, n)[state['pixelCells']]
+    else:
+        levels = np.pad(levels, ((0, 1), (0, 1)), constant_values=n)
+        pixels = levels[rows[:, np.newaxis], cols[np.newaxis, :]]
+
+    img = state['background'].copy()
+    left, top, right, bottom = state['box']
+    area = img[top:bottom, left:right]
+    opaque = pixels < n
+    area[opaque] = state['lut'][pixels[opaque]]
+    return img
+
+
+def stampArrows(state, img, wDir):
+    # alpha-blend the sprite closest to each arrow direction
+    sprites = state['sprites']
+    h, w = sprites.shape[1:3]
+    cols, rows, ys, xs = state['arrowPixels']
+    angle = 270 - seaGrid.field(wDir, state['cells'], ys, xs)
+    valid = np.isfinite(angle)
+    k = np.rint(np.where(valid, angle, 0) * ARROWANGLES / 360).astype(np.intp) % ARROWANGLES
+    H, W = img.shape[:2]
+    for c, r, kk in zip(cols[valid], rows[valid], k[valid]):
+        r0 = r - h // 2
+        c0 = c - w // 2
+        sr0 = max(0, -r0)
+        sc0 = max(0, -c0)
+        sr1 = h - max(0, r0 + h - H)
+        sc1 = w - max(0, c0 + w - W)
+        if sr0 >= sr1 or sc0 >= sc1:
+            continue
+        sprite = sprites[kk, sr0:sr1, sc0:sc1]
+        target = img[r0 + sr0:r0 + sr1, c0 + sc0:c0 + sc1]
+        alpha = sprite[:, :, 3:4].astype(np.uint16)
+        target[:] = ((sprite[:, :, :3] * alpha + target * (255 - alpha)) // 255).astype(np.uint8)
+    return img
+
+
+def renderJpeg(state, waveH, wDir, filename, quality=75):
+    img = stampArrows(state, rasterize(state, waveH), wDir)
+    Image.fromarray(img).save(filename, format='JPEG', quality=quality)
+    return filename
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# File helpers shared by the map frames, tiles and the forecast store
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+
+import os
+import shutil
+from datetime import datetime
+
+
+def linkFile(src, dst):
+    # hard link, a copy where hard links are not supported
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def publishDir(staging, link):
+    # Make staging visible as link in one step: link is a symlink to a
+    # timestamped release directory next to it and is replaced atomically.
+    # The previous release is kept for readers still using it.
+    link = link.rstrip("/")
+    parent = os.path.dirname(link)
+    name = os.path.basename(link)
+    release = name + "-" + datetime.now().strftime("%Y%m%d%H%M%S")
+    os.rename(staging, parent + "/" + release)
+    previous = os.readlink(link) if os.path.islink(link) else None
+    if os.path.isdir(link) and not os.path.islink(link):
+        # one-time migration from a plain directory
+        shutil.rmtree(link)
+    if os.path.lexists(link + ".lnk"):
+        # left by a run that died before the replace
+        os.remove(link + ".lnk")
+    os.symlink(release, link + ".lnk")
+    os.replace(link + ".lnk", link)
+    for entry in os.listdir(parent):
+        if entry.startswith(name + "-") and entry not in (release, previous):
+            shutil.rmtree(parent + "/" + entry, ignore_errors=True)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Shared cache of the 3-hourly resampled CMEMS dataset
+#
+#  (C) Copyright 2019-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# The first job resampling a NC file stores the result as one .npy file per
+# variable plus coordinates and a meta.json, in a directory named after the
+# NC file checksum. Any later job memory-maps it instead of decoding the
+# NetCDF file and resampling again.
+# The NC file is read lazily, one variable and one block of time steps at a
+# time, and resampled straight into memory-mapped .npy files: the working
+# set stays below MEMLIMIT whatever the size of the domain.
+# With SEACELLS, (time, latitude, longitude) variables are stored as
+# (time, cell) arrays of the sea cells only plus the sea mask (see
+# seaGrid.py): land cells are neither averaged nor stored.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import warnings
+import xarray as xr
+import numpy as np
+import instrument
+import seaGrid
+
+
+CACHEDIR = "/tmp/CMEMScache/"
+# resampled entries older than this are removed
+CACHEDAYS = 2
+# hours averaged into one forecast step
+STEPHOURS = 3
+# MB of array data a stage may hold at once
+MEMLIMIT = 512
+# resample and store the sea cells only
+SEACELLS = True
+
+
+def chunkLength(stepBytes, limit=None):
+    # time steps of stepBytes each that fit in the memory ceiling
+    limit = MEMLIMIT if limit is None else limit
+    return max(int(limit * (1 << 20) // max(stepBytes, 1)), 1)
+
+
+def logPeakMemory(stage):
+    own, children = instrument.peakMemory()
+    logging.warning("%s: peak memory %.0f MB (workers %.0f MB)" % (stage, own, children))
+
+
+def fileChecksum(ncfile):
+    h = hashlib.sha1()
+    with open(ncfile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def partialMean(values):
+    # NaN-aware mean over the leading axis of an incomplete bin
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(values, axis=0)[np.newaxis]
+
+
+def binMean(values, hours):
+    # (steps * hours, ...) -> (steps, ...) mean over consecutive hours
+    values = values.reshape((-1, hours) + values.shape[1:])
+    mean = values[:, 0].copy()
+    allMissing = np.isnan(mean)
+    missing = np.empty_like(allMissing)
+    for k in range(1, hours):
+        mean += values[:, k]
+        allMissing &= np.isnan(values[:, k], out=missing)
+    mean /= mean.dtype.type(hours)
+    # only cells with some, but not all, hours missing need the
+    # NaN-aware mean; all-NaN (land) cells stay NaN
+    partial = np.isnan(mean, out=missing)
+    partial ^= allMissing
+    if partial.any():
+        partial = np.nonzero(partial)
+        mean[partial] = partialMean(np.moveaxis(values[(partial[0], slice(None)) + partial[1:]], 1, 0))[0]
+    return mean
+
+
+def timeBins(times, hours=STEPHOURS):
+    # (labels, segments) for a regular hourly axis, None otherwise; each
+    # segment (start, end, partial) covers whole bins of the input axis
+    hour = np.timedelta64(1, 'h')
+    if times.size < 2 or not np.all(np.diff(times) == hour):
+        return None
+
+    # bins are anchored at midnight, as pandas does by default;
+    # the first and last bin may be incomplete
+    width = hours * hour
+    day = times[0].astype('datetime64[D]')
+    binStart = day + ((times[0] - day) // width) * width
+    head = (hours - int((times[0] - binStart) // hour)) % hours
+    head = min(head, times.size)
+    full = (times.size - head) // hours
+    tail = head + full * hours
+    labels = (binStart + np.arange((head > 0) + full + (tail < times.size)) * width).astype(times.dtype)
+
+    segments = []
+    if head:
+        segments.append((0, head, True))
+    if full:
+        segments.append((head, tail, False))
+    if tail < times.size:
+        segments.append((tail, times.size, True))
+    return (labels, segments)
+
+
+def resampleBlock(values, partial, hours=STEPHOURS):
+    # time-first block of whole bins -> its 3-hourly means
+    values = values.astype(np.result_type(values.dtype, np.float32), copy=False)
+    if partial:
+        return partialMean(values)
+    return binMean(values, hours)
+
+
+def timeBlocks(var, segments, hours=STEPHOURS, limit=None):
+    # (output offset, time-first input block, partial) for every block of
+    # whole bins that fits in the memory ceiling; var is read lazily
+    timeAxis = var.get_axis_num('time')
+    stepBytes = max(var.dtype.itemsize, 4) * var.size // var.shape[timeAxis]
+    # input block, its float copy and the bin masks
+    binsPerBlock = chunkLength(3 * hours * stepBytes, limit)
+    offset = 0
+    for start, end, partial in segments:
+        step = end - start if partial else binsPerBlock * hours
+        for a in range(start, end, step):
+            b = min(a + step, end)
+            block = np.moveaxis(var[{'time': slice(a, b)}].values, timeAxis, 0)
+            yield (offset, block, partial)
+            offset += 1 if partial else (b - a) // hours
+
+
+def gridVariables(ds):
+    return [name for name, var in ds.data_vars.items()
+            if set(var.dims) == {'time', 'latitude', 'longitude'}]
+
+
+def storeDownsampled(ds, cacheDir, hours=STEPHOURS, sparse=None, mask=None):
+    # 3-hourly means of ds, labelled like ds.resample(time='3H'), written
+    # straight to the cache entry one block at a time into memory-mapped
+    # .npy files: nothing holds a whole variable. On a regular hourly axis
+    # the means ignore missing hours (np.mean would give NaN for a bin with
+    # some hours missing); irregular axes go through xarray.
+    # mask: the sea mask to use instead of the one of the grid
+    bins = timeBins(ds.time.values, hours)
+    if bins is None:
+        logging.warning("Irregular time axis, resampling with xarray")
+        storeResampled(ds.resample(time=str(hours) + 'H').reduce(np.mean), cacheDir)
+        return
+    labels, segments = bins
+    sparse = SEACELLS if sparse is None else sparse
+    if mask is None and sparse and gridVariables(ds):
+        mask = seaGrid.gridMask(ds, gridVariables(ds), CACHEDIR, MEMLIMIT << 20)
+
+    os.makedirs(CACHEDIR, exist_ok=True)
+    tmpDir = tempfile.mkdtemp(prefix=".tmp-", dir=CACHEDIR)
+    meta = {'coords': {'time': ['time']}, 'variables': {}, 'attrs': {}}
+    np.save(tmpDir + "/coord-time.npy", labels)
+    for name, coord in ds.coords.items():
+        if 'time' not in coord.dims:
+            np.save(tmpDir + "/coord-" + name + ".npy", coord.values)
+            meta['coords'][name] = list(coord.dims)
+    if mask is not None:
+        np.save(tmpDir + "/coord-" + seaGrid.MASKNAME + ".npy", mask)
+        meta['coords'][seaGrid.MASKNAME] = ['latitude', 'longitude']
+    for name, var in ds.data_vars.items():
+        if 'time' not in var.dims:
+            np.save(tmpDir + "/" + name + ".npy", np.ascontiguousarray(var.values))
+            meta['variables'][name] = {'dims': list(var.dims), 'attrs': {}}
+            continue
+        dims = ('time',) + tuple(d for d in var.dims if d != 'time')
+        shape = (labels.size,) + tuple(var.sizes[d] for d in dims[1:])
+        sea = mask is not None and name in gridVariables(ds)
+        if sea:
+            # latitude, longitude in the order of the mask
+            var = var.transpose('time', 'latitude', 'longitude')
+            dims = ('time', seaGrid.CELLDIM)
+            shape = (labels.size, int(mask.sum()))
+        out = np.lib.format.open_memmap(tmpDir + "/" + name + ".npy", mode='w+',
+                                        dtype=np.result_type(var.dtype, np.float32), shape=shape)
+        for offset, block, partial in timeBlocks(var, segments, hours):
+            if sea:
+                try:
+                    block = seaGrid.compress(block, mask)
+                except seaGrid.LandMismatch:
+                    # sea where the mask of the grid has land: widen it
+                    # with this file, once for all the next runs, and
+                    # store again
+                    logging.warning("Sea mask mismatch in " + name)
+                    del out
+                    shutil.rmtree(tmpDir, ignore_errors=True)
+                    mask = seaGrid.widenMask(ds, gridVariables(ds), CACHEDIR, MEMLIMIT << 20, mask)
+                    storeDownsampled(ds, cacheDir, hours, sparse, mask)
+                    return
+            values = resampleBlock(block, partial, hours)
+            out[offset:offset + values.shape[0]] = values
+            del block, values
+        out.flush()
+        del out
+        meta['variables'][name] = {'dims': list(dims), 'attrs': {}}
+    commitEntry(tmpDir, meta, cacheDir)
+
+
+def storeResampled(ds, cacheDir):
+    # write into a private directory and rename it into place, so a
+    # concurrent job only ever sees complete entries
+    os.makedirs(CACHEDIR, exist_ok=True)
+    tmpDir = tempfile.mkdtemp(prefix=".tmp-", dir=CACHEDIR)
+    meta = {'coords': {}, 'variables': {}, 'attrs': ds.attrs}
+    for name in ds.coords:
+        np.save(tmpDir + "/coord-" + name + ".npy", ds[name].values)
+        meta['coords'][name] = list(ds[name].dims)
+    for name in ds.data_vars:
+        np.save(tmpDir + "/" + name + ".npy", np.ascontiguousarray(ds[name].values))
+        meta['variables'][name] = {'dims': list(ds[name].dims), 'attrs': ds[name].attrs}
+    commitEntry(tmpDir, meta, cacheDir)
+
+
+def commitEntry(tmpDir, meta, cacheDir):
+    with open(tmpDir + "/meta.json", 'w') as f:
+        json.dump(meta, f, default=str)
+    try:
+        os.rename(tmpDir, cacheDir)
+    except OSError:
+        # another job stored the same entry first
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def loadResampled(cacheDir, variables=None):
+    with open(cacheDir + "meta.json") as f:
+        meta = json.load(f)
+    coords = {}
+    for name, dims in meta['coords'].items():
+        coords[name] = (dims, np.load(cacheDir + "coord-" + name + ".npy"))
+    data = {}
+    for name, info in meta['variables'].items():
+        if variables is not None and name not in variables:
+            continue
+        data[name] = (info['dims'], np.load(cacheDir + name + ".npy", mmap_mode='r'), info['attrs'])
+    return xr.Dataset(data, coords=coords, attrs=meta['attrs'])
+
+
+def pruneCache(keep):
+    try:
+        entries = os.listdir(CACHEDIR)
+    except OSError:
+        return
+    limit = time.time() - CACHEDAYS * 86400
+    for entry in entries:
+        entryDir = CACHEDIR + entry
+        if entry == keep or not os.path.isdir(entryDir):
+            continue
+        if os.path.getmtime(entryDir) < limit:
+            shutil.rmtree(entryDir, ignore_errors=True)
+
+
+def resampledDir(ncfile, checksum=None):
+    # cache directory holding the 3-hourly resampled ncfile, filled on first
+    # use; pass the checksum when it is already known
+    key = checksum or fileChecksum(ncfile)
+    cacheDir = CACHEDIR + key + "/"
+    if not os.path.isfile(cacheDir + "meta.json"):
+        logging.warning("Resampling " + ncfile + " into " + cacheDir)
+        # cache=False: blocks are read from the file and released
+        with instrument.stage("resample"), xr.open_dataset(ncfile, cache=False) as ds:
+            storeDownsampled(ds, cacheDir)
+        pruneCache(key)
+        logPeakMemory("Resampling")
+    return cacheDir
+
+
+def openResampled(ncfile, variables=None, checksum=None):
+    return loadResampled(resampledDir(ncfile, checksum), variables)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Compact binary store of the spot forecasts
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# One directory holding every spot forecast of a run: per variable an
+# int16 (spots x time) .npy array, plus meta.json with the spot ids, the
+# time table and the fixed-point encoding of each variable. Arrays are
+# memory-mapped on reading, so one spot or one time step is read without
+# the rest. The store path is a symlink to the directory of the last run,
+# switched in one step by fileTools.publishDir().
+# Values are stored as round((value - offset) * scale): heights, periods
+# and wind to the hundredth, as the JSON files show them, wind direction
+# offset by 180 to fit int16, wave direction truncated to int as in the
+# JSON files. MISSING marks NaN. From float32 cubes (CMEMS and NOAA data)
+# the exported JSON is byte-identical to the one getSpotsWindWaves.py
+# writes.
+#
+#   ./forecastStore.py <store dir> <output dir>   export the JSON files
+
+import os
+import sys
+import json
+import tempfile
+import numpy as np
+import spotsJson
+import fileTools
+
+
+MISSING = -32768
+# name: (scale, offset, truncate) of the fixed-point encoding
+ENCODING = {'waveHeight': (100, 0, False),
+            'wavePeriod': (100, 0, False),
+            'waveDir': (1, 0, True),
+            'windSpeed': (100, 0, False),
+            'windDir': (100, 180, False)}
+WINDVARS = ('windSpeed', 'windDir')
+
+
+def quantize(values, scale, offset, truncate):
+    values = np.asarray(values, dtype=np.float64)
+    missing = ~np.isfinite(values)
+    values = np.where(missing, 0., values)
+    if truncate:
+        values = np.trunc(values)
+    q = np.rint((values - offset) * scale)
+    q = np.clip(q, MISSING + 1, np.iinfo(np.int16).max).astype(np.int16)
+    q[missing] = MISSING
+    return q
+
+
+def dequantize(q, scale, offset, truncate):
+    # q: int16 array; offset is added in fixed point, so the result is the
+    # nearest double to the stored decimal value
+    q = np.asarray(q)
+    values = (q.astype(np.float64) + offset * scale) / scale
+    values[q == MISSING] = np.nan
+    return values
+
+
+def writeStore(storeDir, ids, timeTable, waves, wind):
+    # waves, wind: the (spots x time) cubes given to spotsJson.encodeSpots;
+    # the store is replaced as a whole
+    waveH, waveD, waveP = waves
+    vel, direz = wind
+    cubes = {'waveHeight': waveH, 'wavePeriod': waveP, 'waveDir': waveD}
+    if vel is not None:
+        cubes['windSpeed'] = vel
+        cubes['windDir'] = direz
+
+    storeDir = storeDir.rstrip("/")
+    parent = os.path.dirname(storeDir)
+    os.makedirs(parent, exist_ok=True)
+    tmpDir = tempfile.mkdtemp(prefix=".tmp-", dir=parent)
+    os.chmod(tmpDir, 0o755)
+    meta = {'ids': [str(id) for id in ids], 'time': timeTable, 'variables': {}}
+    for name, cube in cubes.items():
+        np.save(tmpDir + "/" + name + ".npy", quantize(cube, *ENCODING[name]))
+        meta['variables'][name] = list(ENCODING[name])
+    with open(tmpDir + "/meta.json", 'w') as f:
+        json.dump(meta, f, separators=(',', ':'))
+    fileTools.publishDir(tmpDir, storeDir)
+    return storeDir
+
+
+def openStore(storeDir):
+    # {'ids', 'index': id -> row, 'time', 'arrays': name -> int16 memmap,
+    #  'encoding': name -> (scale, offset, truncate)}
+    # the release the link points to now, for the meta and the arrays alike
+    storeDir = os.path.realpath(storeDir) + "/"
+    with open(storeDir + "meta.json") as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in meta['variables']:
+        arrays[name] = np.load(storeDir + name + ".npy", mmap_mode='r')
+    return {'ids': meta['ids'], 'index': {id: k for k, id in enumerate(meta['ids'])},
+            'time': meta['time'], 'arrays': arrays,
+            'encoding': {name: tuple(e) for name, e in meta['variables'].items()}}
+
+
+def hasWind(store):
+    return all(name in store['arrays'] for name in WINDVARS)
+
+
+def spotSeries(store, id, name):
+    # one variable of one spot over time, NaN where missing;
+    # KeyError for an unknown spot or variable
+    row = store['index'][str(id)]
+    return dequantize(store['arrays'][name][row], *store['encoding'][name])
+
+
+def timeSlice(store, name, step):
+    # one variable of every spot at time step
+    return dequantize(store['arrays'][name][:, step], *store['encoding'][name])
+
+
+def spotCubes(store, rows):
+    # (waves, wind) cubes of the rows, as spotsJson.encodeSpots() takes them
+    def cube(name):
+        return dequantize(store['arrays'][name][rows], *store['encoding'][name])
+    waves = (cube('waveHeight'), cube('waveDir'), cube('wavePeriod'))
+    wind = (cube('windSpeed'), cube('windDir')) if hasWind(store) else (None, None)
+    return (waves, wind)
+
+
+def exportJson(store, outdir, ids=None, block=10000):
+    # write <outdir>/<id>.json of the given spots (default: all) in the
+    # format of getSpotsWindWaves.py; returns the number of files
+    ids = store['ids'] if ids is None else [str(id) for id in ids]
+    outdir = outdir.rstrip("/") + "/"
+    for k in range(0, len(ids), block):
+        chunk = ids[k:k + block]
+        rows = np.array([store['index'][id] for id in chunk], dtype=np.intp)
+        waves, wind = spotCubes(store, rows)
+        for id, document in zip(chunk, spotsJson.encodeSpots(store['time'], waves, wind)):
+            spotsJson.writeFile(outdir + id + ".json", document)
+    return len(ids)
+
+
+###################################
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: forecastStore.py <store dir> <output dir>")
+        sys.exit(1)
+    os.makedirs(sys.argv[2], exist_ok=True)
+    print(exportJson(openStore(sys.argv[1]), sys.argv[2]), "spot files written")
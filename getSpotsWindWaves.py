@@ -18,124 +18,144 @@
 # v.2.0.0 - april 2019 
 # v.2.0.1 - feb. 2020 - new NOAA server
 
-import pymysql
-from pymysql import MySQLError
-import subprocess
 import sys
 import os
 from datetime import datetime, timedelta
 import logging
-import urllib.request
 from urllib.error import URLError, HTTPError
-import shutil
 from time import strftime
 import xarray as xr
-import pandas as pd
-import numpy as np
-import tempfile
-import math
-import json
 import warnings
+import spotsExtract
+import spotIndex
+import spotsJson
+import forecastStore
+import spotsDb
+import instrument
+import forecastCache
+import noaaWind
+import downloads
+import downloadCache
+import motuPlanner
+import upstreamProbe
 
 
 warnings.filterwarnings(action='ignore', category=FutureWarning, module='xarray')
 path = os.path.dirname(os.path.abspath(__file__))
-sys.path.insert(0, path + '/db/')
-import dbaseconfig as cfg
 
 LOGFORMAT = '%(asctime)s - %(message)s'
 LOGFILE = path + "/log/" + 'getSpotsWindWaves.log'
 logging.basicConfig(filename=LOGFILE, format=LOGFORMAT, level=logging.WARN)
 
 MOTUCLIENT = '/usr/local/bin/motuclient'
-OUTDIR = "/tmp/"
-OUTNOAAFILE = ''
+SERVICE = 'MEDSEA_ANALYSIS_FORECAST_WAV_006_017-TDS'
+# persistent NOAA wind store, updated incrementally by getNOAAFile()
+NOAA_FILE = noaaWind.STOREFILE
 FORECAST_FILEPATH = path + '/CMEMS-NOAA/'
+# digest of every spot file as last written
+DIGESTFILE = path + '/cache/spotDigests.json'
+# ids of the spot files rewritten by the last run, one per line
+CHANGEDFILE = path + '/CMEMS-NOAA-changed.txt'
+# binary store of all spot forecasts (see forecastStore.py)
+FORECASTSTORE = path + '/CMEMS-NOAA.store/'
+# also write the per-spot JSON files (else: forecastStore.py exports them)
+WRITEJSON = True
 FROMEMAIL = "Root <fm@fabiomarzocca.com>"
 TOEMAIL = "marzoccafabio@gmail.com"
 endDate=""
 windValid = True
-NC_FILE = "/tmp/msCMEMSdaily.nc"
-
-
-def getNCFiles(minLat, minLon, maxLat, maxLon):
-    global endDate
-    startDate = datetime.utcnow().strftime("%Y-%m-%d")
-    endNOAAdate = getNOAAlastDate()
-    if endNOAAdate==False:
-        endNOAAdate = (datetime.now().date()+timedelta(days=6)).isoformat() + "T12:00:00Z"
+# CMEMS NC file in the download cache, set by getCMEMSFile()
+NC_FILE = ""
+
+
+def getCMEMSFile(minLat, minLon, maxLat, maxLon, startDate):
+    global NC_FILE
+    variables = ('VHM0', 'VMDR', 'VTM10')
+    params = downloadCache.requestParams(SERVICE, minLat, minLon, maxLat, maxLon,
+                                         startDate, endDate, variables)
+    cached = downloadCache.lookup(params)
+    if cached:
+        logging.warning("CMEMS NC File already downloaded: " + cached)
+        NC_FILE = cached
+        return True
 
-    # processing: send request to MOTU to get the file url
+    # processing and download in parallel pieces (see motuPlanner.py)
     logging.warning("Start processing MOTU request")
-    requestUrl = subprocess.getoutput(MOTUCLIENT +' -s MEDSEA_ANALYSIS_FORECAST_WAV_006_017-TDS  -x ' + minLon + ' -X ' +
-                                      maxLon + ' -y ' + minLat + ' -Y ' + maxLat + ' -t ' +
-                                      startDate + ' -T ' + endDate + ' -v VHM0 -v VMDR -v VTM10 -q -o console')
-
-    if "http://" not in requestUrl:
+    try:
+        NC_FILE = motuPlanner.download(MOTUCLIENT, params, "CMEMS")
+    except motuPlanner.MotuError as e:
         logging.warning('Processing MOTU request failed!')
-        send_notice_mail('Processing MOTU request failed!\n' + requestUrl)
+        send_notice_mail('Processing MOTU request failed!\n' + str(e))
         return False
-
-    logging.warning("Successfully processed MOTU request")
-
-    #delete old nc file
-    if (os.path.isfile(NC_FILE)):
-        os.remove(NC_FILE)
-
-    # downloading CMEMS NC file
-    myurl = "http://" + requestUrl.split("http://")[1]
-    try:
-        logging.warning("Start downloading CMEMS NC file")
-        with urllib.request.urlopen(myurl) as response, open(NC_FILE, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
     except (HTTPError, URLError) as e:
-        logging.warning("Can't download CMEMS NC file: " +
-                        myurl + " -> " + str(e.reason))
-        send_notice_mail("Can't download CMEMS NC file: " +
-                         myurl + " -> " + str(e.reason))
+        logging.warning("Can't download CMEMS NC file: " + str(e.reason))
+        send_notice_mail("Can't download CMEMS NC file: " + str(e.reason))
+        return False
+    except (OSError, ValueError) as e:
+        logging.warning("Can't merge CMEMS NC file: " + str(e))
+        send_notice_mail("Can't merge CMEMS NC file: " + str(e))
         return False
 
     logging.warning("CMEMS NC File: " + NC_FILE +
                     " successfully dowloaded.")
+    return True
 
-    # Download NOAA wind NC file
-    NOAAurl = "https://coastwatch.pfeg.noaa.gov/erddap/griddap/NCEP_Global_Best.nc?ugrd10m[(" + startDate + "T00:00:00Z):1:(" + endNOAAdate + ")][(" + minLat + \
-        "):1:(" + maxLat + ")][(0):1:(359.5)],vgrd10m[(" + startDate + "T00:00:00Z):1:(" + \
-              endNOAAdate + ")][(" + minLat + \
-        "):1:(" + maxLat + ")][(0):1:(359.5)]"
+def getNOAAFile(minLat, minLon, maxLat, maxLon):
+    endNOAAdate = getNOAAlastDate()
+    if endNOAAdate==False:
+        endNOAAdate = (datetime.now().date()+timedelta(days=6)).isoformat() + "T12:00:00Z"
 
+    # Download NOAA wind time steps not in the store yet, Mediterranean longitudes only
     try:
         logging.warning("Start downloading NOAA NC file")
-        with urllib.request.urlopen(NOAAurl) as response, open(OUTDIR + OUTNOAAFILE, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
-            logging.warning("NOAA NC File: " + OUTDIR + OUTNOAAFILE +
-                    " successfully dowloaded.")
+        noaaWind.updateStore(endNOAAdate, minLat, minLon, maxLat, maxLon, NOAA_FILE)
+        logging.warning("NOAA NC File: " + NOAA_FILE +
+                " successfully updated.")
     except (HTTPError, URLError) as e:
         logging.warning("Can't download NOAA NC file: " +
-                        NOAAurl + " -> " + str(e.reason))
+                        noaaWind.ERDDAP + " -> " + str(e.reason))
         send_notice_mail("Can't download NOAA NC file: " +
-                         NOAAurl + " -> " + str(e.reason))
-
+                         noaaWind.ERDDAP + " -> " + str(e.reason))
+        return False
+    except (OSError, IOError, ValueError) as e:
+        logging.warning("Can't update NOAA wind store: " + str(e))
+        send_notice_mail("Can't update NOAA wind store: " + str(e))
+        return False
     return True
 
+@instrument.timed("spots.getNCFiles")
+def getNCFiles(minLat, minLon, maxLat, maxLon):
+    global windValid
+    startDate = datetime.utcnow().strftime("%Y-%m-%d")
+
+    # CMEMS and NOAA are independent: fetch them at the same time.
+    # A failed NOAA update only disables wind data
+    cmemsOk, noaaOk = downloads.runParallel([
+        lambda: getCMEMSFile(minLat, minLon, maxLat, maxLon, startDate),
+        lambda: getNOAAFile(minLat, minLon, maxLat, maxLon)])
+    if not noaaOk:
+        windValid = False
+    return cmemsOk
+
 def getNOAAlastDate():
-    url = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/NCEP_Global_Best.json?time[last]'
-    try:
-        res=urllib.request.urlopen(url)
-    except (HTTPError, URLError) as e:
-        logging.warning("Can't get NOAA lastTime: " + str(e.reason))
-        send_notice_mail("Can't get NOAA lastTime: " +  str(e.reason))
+    # from the probe cache, probed along with the CMEMS coverage; after a
+    # failed probe, the last value probed successfully
+    noaa = upstreamProbe.probe(erddap=noaaWind.ERDDAP)['noaa']
+    if noaa['error'] and noaa['value']:
+        logging.warning("Can't get NOAA lastTime: " + noaa['error'] + ", using " + noaa['value'])
+    elif noaa['error']:
+        logging.warning("Can't get NOAA lastTime: " + noaa['error'])
+        send_notice_mail("Can't get NOAA lastTime: " + noaa['error'])
         return False
-    data = json.loads(res.read().decode('utf-8'))
-    lastTime = data['table']['rows'][0][0]
-    return lastTime
+    return noaa['value']
 
+@instrument.timed("spots.initDataArrays")
 def initDataArrays():
     global myNOAAdata, myCMEMSdata, windValid, timeTable
 
     # NOAA
     try:
-        myNOAAdata = xr.open_dataset(OUTDIR+OUTNOAAFILE)
+        myNOAAdata = xr.open_dataset(NOAA_FILE)
     except (OSError, IOError, RuntimeError) as e:
         logging.warning("Can't initialize NOAA dataset - " + " " + str(e))
         send_notice_mail("Can't initialize NOAA dataset - " + " " + str(e))
@@ -143,184 +163,126 @@ def initDataArrays():
 
     #Copernicus
     try:
-        myCMEMSdata = xr.open_dataset(NC_FILE).resample(time='3H').reduce(np.mean)
-        
+        # resampled once per NC file, shared with getWavesMaps.py
+        myCMEMSdata = forecastCache.openResampled(NC_FILE, checksum=downloadCache.checksumOf(NC_FILE))
     except (OSError, IOError, RuntimeError) as e:
         logging.warning("Can't initialize CMEMS dataset - " + " " + str(e))
         send_notice_mail("Can't initialize CMEMS dataset - " + " " + str(e))
         sys.exit()
 
     # time array
-    dt = pd.to_datetime(myCMEMSdata.time.values)
-    a0 = [str(i.date()) for i in dt]
-    a1 = [str(i.time())[0:2] for i in dt]
-    timeTable = np.vstack((a0, a1))
-    timeTable = timeTable.tolist()
-
-def getWavesData(spotLat, spotLon):
-    x = np.abs(myCMEMSdata.longitude.values - spotLon).argmin()
-    y = np.abs(myCMEMSdata.latitude.values - spotLat).argmin()
-    waveH = myCMEMSdata.VHM0.values[0::1,y,x]
-    waveH = waveH.tolist()
-    waveHeight =[]
-    for item in waveH:
-        waveHeight.append("%.2f"%item)
-    del waveH
-
-    waveD = myCMEMSdata.VMDR.values[0::1,y,x]
-    waveD = waveD.tolist()
-    waveDirection =[]
-    for item in waveD:
-        waveDirection.append(int(item))
-    del waveD
-
-    waveP = myCMEMSdata.VTM10.values[0::1,y,x]
-    waveP = waveP.tolist()
-    wavePeriod =[]
-    for item in waveP:
-        wavePeriod.append("%.2f"%item)
-    del waveP
-
-    return (waveHeight, waveDirection, wavePeriod)
-
-def getWindData(spotLat, spotLon):
+    timeTable = spotsJson.timeTable(myCMEMSdata.time.values)
+
+def getWavesData(spotIds, spotLats, spotLons):
+    cells = spotIndex.lookup('cmems', myCMEMSdata, spotIds, spotLats, spotLons, seaVar='VHM0')
+    cubes = spotsExtract.extractWaves(myCMEMSdata, spotLats, spotLons, cells)
+    return (cubes['VHM0'], cubes['VMDR'], cubes['VTM10'])
+
+def getWindData(spotIds, spotLats, spotLons):
     if (windValid == False):
-        return (np.full((1, 36), "n/a").tolist()[0], np.full((1, 36), "n/a").tolist()[0])
-
-    if spotLon < 0:
-        spotLon = 360 + spotLon
-        if spotLon > 359.5:
-            spotLon = 359.49
-
-    y = np.abs(myNOAAdata.latitude.values - spotLat).argmin()
-    x = np.abs(myNOAAdata.longitude.values - spotLon).argmin()
-
-    ugrd = myNOAAdata.ugrd10m.values[0::1, y, x]
-    vgrd = myNOAAdata.vgrd10m.values[0::1, y, x]
-
-    # wind intensity
-    # build an array from 2 arrays applying for each element: sqrt(vgrd^2+ugrd^2)
-    vel = np.sqrt(np.add(np.multiply(vgrd, vgrd), np.multiply(ugrd, ugrd)))
-    vel = vel * 1.9438444924574  # convert to knots
-    intensitaVento = []
-    for item in vel:
-        intensitaVento.append("%.2f" % item)
-
-    # wind direction
-    direz = 270 - np.arctan2(vgrd, ugrd) * (180 / math.pi)
-    # for every array item, if direz>360, then direz=direz-360
-    direz[direz > 360] = direz[direz > 360] - 360  
-    direz = direz.tolist()
-    direzioneVento = []
-    for item in direz:
-        direzioneVento.append("%.2f" % item)
-    del direz
-    del vel
-    return(intensitaVento, direzioneVento)
+        return (None, None)
+    cells = spotIndex.lookup('noaa', myNOAAdata, spotIds, spotLats, spotLons)
+    return spotsExtract.extractWind(myNOAAdata, spotLats, spotLons, cells)
 
+@instrument.timed("spots.readData")
 def readData():
+    # (ids, lats, lons) of all spots
     try:
-        db = pymysql.connect(cfg.mysql['host'], cfg.mysql[
-                             'user'], cfg.mysql['passwd'], cfg.mysql['db'])
-    except MySQLError as e:
-        logging.warning("Error: unable to connect to DB ")
-        send_notice_mail("Error: unable to connect to DB ")
-        return
-    cursor = db.cursor()
-    sql = "SELECT * FROM spots WHERE 1"
-    try:
-        cursor.execute(sql)
-        results = cursor.fetchall()
-    except:
-        logging.warning("Error: unable to fetch data from Database")
+        return spotsDb.readSpots()
+    except spotsDb.DBERRORS as e:
+        logging.warning("Error: unable to fetch data from Database - " + str(e))
         send_notice_mail("Error: unable to fetch data from Database")
-        db.close()
         return
-    db.close()
-    # id = line[5]
-    # Lat = line[4]
-    # Lon = line[3]
-    return results
+    except spotsDb.ColumnsError as e:
+        logging.warning("Error: unknown spots columns - " + str(e))
+        send_notice_mail("Error: unknown spots columns - " + str(e))
+        return
+    except (OSError, IOError, ValueError) as e:
+        logging.warning("Error: unable to read the spots snapshot - " + str(e))
+        send_notice_mail("Error: unable to read the spots snapshot")
+        return
+
 
+@instrument.timed("spots.saveSpots")
+def saveSpots(dbData):
+    spotIds, spotLats, spotLons = dbData
 
-def saveSpot(lat, lon, id):
-    intensitaVento, direzioneVento = getWindData(lat, lon)
-    waveHeight, waveDir, wavePeriod = getWavesData(lat,lon)
+    # one batch extraction for all spots: (spots x time) cubes
+    with instrument.stage("spots.extractWaves") as record:
+        record['spots'] = len(spotIds)
+        waves = getWavesData(spotIds, spotLats, spotLons)
+    with instrument.stage("spots.extractWind") as record:
+        record['spots'] = len(spotIds)
+        wind = getWindData(spotIds, spotLats, spotLons)
 
-    Data = []
-    Data.append({'time': timeTable, 'waveHeight': waveHeight,
-                 'wavePeriod': wavePeriod, 'waveDir': waveDir, 
-                 'windSpeed': intensitaVento, 'windDir': direzioneVento})
-    Data = Data[0]
-    print(json.dumps(Data, separators=(',', ':')), file=open(FORECAST_FILEPATH + str(id) + ".json", 'w'))
+    with instrument.stage("spots.store") as record:
+        record['spots'] = len(spotIds)
+        forecastStore.writeStore(FORECASTSTORE, spotIds, timeTable, waves, wind)
+    if not WRITEJSON:
+        return
 
-    del Data
+    # all spot files formatted at once; only changed ones are written
+    with instrument.stage("spots.encode") as record:
+        record['spots'] = len(spotIds)
+        documents = spotsJson.encodeSpots(timeTable, waves, wind)
+    with instrument.stage("spots.write") as record:
+        changed = spotsJson.writeChanged(FORECAST_FILEPATH, spotIds, documents, DIGESTFILE)
+        spotsJson.writeFile(CHANGEDFILE, "".join(str(id) + "\n" for id in changed).encode())
+        record['spots'] = len(spotIds)
+        record['written'] = len(changed)
+    logging.warning("Spot files: %d changed of %d" % (len(changed), len(spotIds)))
 
 
+def updateSpots(dbData):
+    #Initialize Datasets
+    initDataArrays()
+
+    # Analyze and save spots
+    saveSpots(dbData)
+    forecastCache.logPeakMemory("Spots")
+
+    # update DB updatedOn
+    updateDBDate()
+
+    # write update date/time
+    now = datetime.now()
+    now = now.strftime("%Y-%m-%d %H:%M")
+    g = open(path + '/CMEMS-update-spots.txt', 'w', encoding='utf-8')
+    g.write(now)
+    g.close()
+
+
+@instrument.timed("spots.updateDBDate")
 def updateDBDate():
     try:
-        db = pymysql.connect(cfg.mysql['host'], cfg.mysql[
-                             'user'], cfg.mysql['passwd'], cfg.mysql['db'])
-    except MySQLError as e:
-        logging.warning("Error: unable to connect to DB ")
-        send_notice_mail("Error: unable to connect to DB ")
-        return
-    cursor = db.cursor()
-    sql = "UPDATE service SET updatedOn = CURRENT_DATE"
-    try:
-        cursor.execute(sql)
-        db.commit()
-    except:
-        logging.warning("Error: unable to update data in Database")
+        spotsDb.setUpdatedToday()
+    except spotsDb.DBERRORS as e:
+        logging.warning("Error: unable to update data in Database - " + str(e))
         send_notice_mail("Error: unable to update data in Database")
-    db.close()
 
 
 def isDbUpdated():
     try:
-        db = pymysql.connect(cfg.mysql['host'], cfg.mysql[
-                             'user'], cfg.mysql['passwd'], cfg.mysql['db'])
-    except MySQLError as e:
-        logging.warning("Error: unable to connect to DB ")
-        send_notice_mail("Error: unable to connect to DB ")
-        return
-    cursor = db.cursor()
-    sql = "SELECT updatedOn FROM service"
-    try:
-        cursor.execute(sql)
-        dateDB = cursor.fetchone()[0]
-    except:
-        logging.warning("Error: unable to fetch updatedOn from Database")
+        return spotsDb.isUpdatedToday()
+    except spotsDb.DBERRORS as e:
+        logging.warning("Error: unable to fetch updatedOn from Database - " + str(e))
         send_notice_mail("Error: unable to fetch updatedOn from Database")
-        db.close()
-        return False
-    now = datetime.now().date().strftime('%Y-%m-%d')
-    if now == dateDB:
-        return True
-    else:
         return False
 
 
+@instrument.timed("spots.todayProductionUpdate")
 def todayProductionUpdate():
     global endDate
-    requestEndDateCoverage = subprocess.getoutput(
-        MOTUCLIENT + ' -s MEDSEA_ANALYSIS_FORECAST_WAV_006_017-TDS  -D -q -o console | grep "timeCoverage" ')
-
-    if 'msg="OK"' not in requestEndDateCoverage:
-        logging.warning('Processing MOTU EndDateCoverage request failed!')
-        send_notice_mail('Processing MOTU EndDateCoverage request failed!')
+    # coverage end from the probe cache shared with getWavesMaps.py; the
+    # NOAA last time is probed at the same time for getNOAAlastDate()
+    coverage = upstreamProbe.probe(MOTUCLIENT, SERVICE, noaaWind.ERDDAP)['coverage']
+    if coverage['error']:
+        logging.warning('Processing MOTU EndDateCoverage request failed! ' + coverage['error'])
+        send_notice_mail('Processing MOTU EndDateCoverage request failed! ' + coverage['error'])
         return False
 
-    
-    requestEndDateCoverage = requestEndDateCoverage.strip().replace('"', '')
-    b = requestEndDateCoverage.find('end=')+4
-    parsedDate = requestEndDateCoverage[b:b+10]
-    
-    endDate = parsedDate
-    dateInterval = (datetime.strptime(
-        parsedDate, "%Y-%m-%d").date() - datetime.now().date()).days
-
-    if dateInterval >= 4:
+    endDate = coverage['value'][:10]
+    if upstreamProbe.coverageDays(coverage['value']) >= upstreamProbe.MINDAYS:
         return True
     else:
         logging.warning('Coverage date interval <4 days!')
@@ -355,14 +317,13 @@ def send_notice_mail(text):
 
 ###################################
 if __name__ == '__main__':
+    instrument.start("getSpotsWindWaves")
 
     minLon = '-10'
     maxLon = "36.5"
     minLat = '30'
     maxLat = "46"
 
-    OUTNOAAFILE = next(tempfile._get_candidate_names()) + ".nc"
-
     # Check if we have already updated for today,
     # if not, check if a Product's update is already available
     if isDbUpdated() == True:
@@ -379,26 +340,7 @@ if __name__ == '__main__':
 
     # read all spots coords from DB
     dbData = readData()
-    if not dbData:
+    if not dbData or not dbData[0]:
         sys.exit()
 
-    #Initialize Datasets
-    initDataArrays()
-
-    # Analyze and save spots
-    for line in dbData:
-        saveSpot(float(line[4]), float(line[3]), line[5])
-
-    # update DB updatedOn
-    updateDBDate()
-
-    # write update date/time
-    now = datetime.now()
-    now = now.strftime("%Y-%m-%d %H:%M")
-    g = open(path + '/CMEMS-update-spots.txt', 'w', encoding='utf-8')
-    g.write(now)
-    g.close()
-
-    # delete NOAA nc file
-    if (os.path.isfile(OUTDIR+OUTNOAAFILE)):
-        os.remove(OUTDIR+OUTNOAAFILE)
+    updateSpots(dbData)
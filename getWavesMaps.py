@@ -17,7 +17,6 @@
 
 import matplotlib
 matplotlib.use('Agg')
-import xarray as xr
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -28,13 +27,22 @@ import sys
 import os
 from dateutil import parser
 import shutil
-from datetime import datetime, timedelta, date
-import subprocess
-import urllib.request
+from datetime import datetime, date
 from urllib.error import URLError, HTTPError
 from time import strftime
 import warnings
-import gc
+import time
+import multiprocessing
+import hashlib
+import forecastCache
+import instrument
+import downloadCache
+import motuPlanner
+import upstreamProbe
+import fastRender
+import seaGrid
+import mapTiles
+import fileTools
 
 
 warnings.filterwarnings(action='ignore', category=FutureWarning, module='xarray')
@@ -48,39 +56,73 @@ FROMEMAIL = "Root <fm@fabiomarzocca.com>"
 TOEMAIL = "marzoccafabio@gmail.com"
 
 
-TEMPDIR = "/tmp/CMEMSmaps/"
-NC_FILE= "/tmp/msCMEMSdaily.nc"
+# staged next to CMEMSmaps and the frame cache: renames and hard links
+# stay on one filesystem
+TEMPDIR = path + "/CMEMSmaps.new/"
+# CMEMS NC file in the download cache, set by getNCFiles()
+NC_FILE= ""
 MOTUCLIENT = '/usr/local/bin/motuclient'
-
-
+SERVICE = 'MEDSEA_ANALYSIS_FORECAST_WAV_006_017-TDS'
+endDate = ""
+# number of processes rendering map frames (1 = render in this process)
+MAPWORKERS = os.cpu_count() or 1
+# map box (minLon, minLat, maxLon, maxLat), relief scale and figure size
+MAPEXTENT = (-10., 30., 36.5, 46.)
+RELIEFSCALE = 0.65
+FIGSIZE = (20.48, 10.24)
+CACHEDIR = path + "/cache/"
+backgrounds = {}
+# rendered frames, reused when the data and parameters of a step match;
+# frames not reused for FRAMECACHEDAYS are removed
+FRAMECACHEDIR = CACHEDIR + "frames/"
+FRAMECACHEDAYS = 3
+# render frames with fastRender (NumPy + PIL) instead of matplotlib/Basemap
+FASTRENDER = True
+# also write the maps as an XYZ tile pyramid into CMEMStiles/
+TILES = False
+# staged next to CMEMStiles/: hard links between steps survive the move
+TILETEMPDIR = path + "/CMEMStiles.new/"
+# start method of the render and tile worker pools: runPipeline.py renders
+# the maps while the spots thread may hold netCDF4/HDF5, BLAS or xarray
+# locks, which forked workers would inherit held
+STARTMETHOD = 'spawn'
+# settings the workers take from this process instead of their defaults
+WORKERSETTINGS = ('path', 'TEMPDIR', 'CACHEDIR', 'FRAMECACHEDIR', 'FASTRENDER', 'MAPEXTENT',
+                  'RELIEFSCALE', 'FIGSIZE', 'ARROWSTYLE')
+# quiver() style of the waves direction arrows
+ARROWSTYLE = dict(edgecolor='lightgray', minshaft=4,  width=0.007, headwidth=3., headlength=4., linewidth=.5)
+
+
+@instrument.timed("maps.getNCFiles")
 def getNCFiles(minLat, minLon, maxLat, maxLon):
+    global NC_FILE
     startDate = datetime.utcnow().strftime("%Y-%m-%d")
-    endDate = (datetime.now().date()+timedelta(days=10)).strftime("%Y-%m-%d")
 
-    # processing: send request to MOTU to get the file url
-    logging.warning("Start processing MOTU request")
-    requestUrl = subprocess.getoutput(MOTUCLIENT + ' -s MEDSEA_ANALYSIS_FORECAST_WAV_006_017-TDS  -x ' + minLon + ' -X ' +
-                                      maxLon + ' -y ' + minLat + ' -Y ' + maxLat + ' -t ' +
-                                      startDate + ' -T ' + endDate + ' -v VHM0 -v VMDR -q -o console')
+    # the spots job downloads a superset (VTM10 too) of the same request:
+    # reuse its file when it is already in the cache
+    params = downloadCache.requestParams(SERVICE, minLat, minLon, maxLat, maxLon,
+                                         startDate, endDate, ('VHM0', 'VMDR'))
+    cached = downloadCache.lookup(params)
+    if cached:
+        logging.warning("CMEMS NC File already downloaded: " + cached)
+        NC_FILE = cached
+        return True
 
-    if "http://" not in requestUrl:
+    # processing and download in parallel pieces (see motuPlanner.py)
+    logging.warning("Start processing MOTU request")
+    try:
+        NC_FILE = motuPlanner.download(MOTUCLIENT, params, "CMEMS")
+    except motuPlanner.MotuError as e:
         logging.warning('Processing MOTU for maps request failed!')
-        send_notice_mail('Processing MOTU for maps request failed!\n' + requestUrl)
+        send_notice_mail('Processing MOTU for maps request failed!\n' + str(e))
         return False
-
-    logging.warning("Successfully processed MOTU request")
-
-    # downloading CMEMS NC file
-    myurl = "http://" + requestUrl.split("http://")[1]
-    try:
-        logging.warning("Start downloading CMEMS NC file")
-        with urllib.request.urlopen(myurl) as response, open(NC_FILE, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
     except (HTTPError, URLError) as e:
-        logging.warning("Can't download CMEMS NC file: " +
-                        myurl + " -> " + str(e.reason))
-        send_notice_mail("Can't download CMEMS NC file for maps: " +
-                         myurl + " -> " + str(e.reason))
+        logging.warning("Can't download CMEMS NC file: " + str(e.reason))
+        send_notice_mail("Can't download CMEMS NC file for maps: " + str(e.reason))
+        return False
+    except (OSError, ValueError) as e:
+        logging.warning("Can't merge CMEMS NC file: " + str(e))
+        send_notice_mail("Can't merge CMEMS NC file for maps: " + str(e))
         return False
 
     logging.warning("CMEMS NC File: " + NC_FILE +
@@ -88,7 +130,7 @@ def getNCFiles(minLat, minLon, maxLat, maxLon):
     return True
 
 def testOneShot(ncfile):
-    myCMEMSdata = xr.open_dataset(ncfile).resample(time='3H').reduce(np.mean)
+    myCMEMSdata = forecastCache.openResampled(ncfile)
 
     # time 
     lastDate =myCMEMSdata.time.values[myCMEMSdata.time.values.size-1]
@@ -112,13 +154,15 @@ def testOneShot(ncfile):
                        myCMEMSdata.latitude.values)
     x, y = map(X, Y)
 
+    cells = seaGrid.maskOf(myCMEMSdata)
+    cells = None if cells is None else seaGrid.cellIndex(cells)
     waveH = myCMEMSdata.VHM0.values
     wDir = myCMEMSdata.VMDR.values
     del myCMEMSdata
  
 
     my_cmap = plt.get_cmap('rainbow')
-    onde = map.pcolormesh(x, y, waveH[0,:,:], cmap=my_cmap, norm=matplotlib.colors.LogNorm(vmin=0.07, vmax=4.,clip=True))
+    onde = map.pcolormesh(x, y, seaGrid.field(waveH[0], cells), cmap=my_cmap, norm=matplotlib.colors.LogNorm(vmin=0.07, vmax=4.,clip=True))
     
     #plt.colorbar();
 
@@ -128,63 +172,285 @@ def testOneShot(ncfile):
     xx = np.arange(0, x.shape[1], 15)
     points = np.meshgrid(yy,xx)
 
-    wDir = wDir[0,:,:]
+    wDir = seaGrid.field(wDir[0], cells, *points)
     
-    map.quiver(x[points],y[points],np.cos(np.deg2rad(270-wDir[points])),np.sin(np.deg2rad(270-wDir[points])),
+    map.quiver(x[points],y[points],np.cos(np.deg2rad(270-wDir)),np.sin(np.deg2rad(270-wDir)),
     	edgecolor='lightgray', minshaft=4,  width=0.007, headwidth=3., headlength=4., linewidth=.5)
 
     plt.show()
-    plt.savefig("prova_s065.jpg", quality=75)
+    plt.savefig("prova_s065.jpg", pil_kwargs={'quality': 75})
     plt.close()
 
-def getMaps(ncfile):
-    myCMEMSdata = xr.open_dataset(ncfile).resample(time='3H').reduce(np.mean)
-
+def newBasemap():
     # projection, lat/lon extents and resolution of polygons to draw
     # resolutions: c - crude, l - low, i - intermediate, h - high, f - full
-    map = Basemap(projection='merc', llcrnrlon=-10.,
-                  llcrnrlat=30., urcrnrlon=36.5, urcrnrlat=46.)
-
+    return Basemap(projection='merc', llcrnrlon=MAPEXTENT[0],
+                   llcrnrlat=MAPEXTENT[1], urcrnrlon=MAPEXTENT[2], urcrnrlat=MAPEXTENT[3])
+
+def backgroundFile(extent=MAPEXTENT, scale=RELIEFSCALE, figsize=FIGSIZE):
+    key = hashlib.md5(repr((tuple(extent), scale, tuple(figsize))).encode()).hexdigest()
+    return CACHEDIR + "background-" + key + ".npy"
+
+def getBackground(extent=MAPEXTENT, scale=RELIEFSCALE, figsize=FIGSIZE):
+    # whole-figure RGB raster of the shaded relief, rendered once and
+    # cached in memory and on disk (kept across daily runs)
+    bgfile = backgroundFile(extent, scale, figsize)
+    if bgfile in backgrounds:
+        return backgrounds[bgfile]
+    try:
+        backgrounds[bgfile] = np.load(bgfile, mmap_mode='r')
+        return backgrounds[bgfile]
+    except (OSError, IOError, ValueError):
+        pass
 
-    X, Y = np.meshgrid(myCMEMSdata.longitude.values,
-                       myCMEMSdata.latitude.values)
+    logging.warning("Rendering map background: " + bgfile)
+    map = Basemap(projection='merc', llcrnrlon=extent[0],
+                  llcrnrlat=extent[1], urcrnrlon=extent[2], urcrnrlat=extent[3])
+    fig = plt.figure(figsize=figsize)
+    map.shadedrelief(scale=scale)
+    fig.canvas.draw()
+    bg = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+    plt.close(fig)
+
+    os.makedirs(CACHEDIR, exist_ok=True)
+    tmpfile = bgfile + "." + str(os.getpid()) + ".npy"
+    np.save(tmpfile, bg)
+    os.replace(tmpfile, bgfile)
+    backgrounds[bgfile] = bg
+    return bg
+
+def arrowSprites(map, inv, box, scale, height):
+    # one RGBA sprite per arrow direction, drawn by quiver() with the frame
+    # layout, style and autoscaled length, tail at the sprite center
+    left, top, right, bottom = box
+    radius = int((right - left) / scale) + 8
+    size = 2 * radius + 1
+    across = max((right - left) // size - 1, 1)
+    down = max((bottom - top) // size - 1, 1)
+    angles = np.arange(fastRender.ARROWANGLES) * 360. / fastRender.ARROWANGLES
+    sprites = np.zeros((len(angles), size, size, 4), dtype=np.uint8)
+    for start in range(0, len(angles), across * down):
+        batch = np.arange(start, min(start + across * down, len(angles)))
+        cols = left + size * (1 + batch % across - start % across)
+        rows = top + size * (1 + (batch - start) // across)
+        tails = inv.transform(np.column_stack([cols + 0.5, height - rows - 0.5]))
+
+        fig = plt.figure(figsize=FIGSIZE)
+        fig.patch.set_alpha(0)
+        ax = plt.gca()
+        map.quiver(tails[:, 0], tails[:, 1], np.cos(np.deg2rad(angles[batch])), np.sin(np.deg2rad(angles[batch])),
+                   scale=scale, **ARROWSTYLE)
+        ax.axis('off')
+        ax.patch.set_visible(False)
+        fig.canvas.draw()
+        rgba = np.asarray(fig.canvas.buffer_rgba())
+        for k, c, r in zip(batch, cols, rows):
+            sprites[k] = rgba[r - radius:r + radius + 1, c - radius:c + radius + 1]
+        plt.close(fig)
+    return sprites
+
+def waveColors():
+    # the 256 colors of the wave height colormap
+    return (plt.get_cmap('rainbow')(np.arange(256))[:, :3] * 255).round().astype(np.uint8)
+
+def initFastRenderer(map, x, y, points, lons, lats, cells=None):
+    # frame geometry as matplotlib lays it out, measured once on a
+    # reference frame: map box pixels, pixel coordinates, arrow positions
+    fig = plt.figure(figsize=FIGSIZE)
+    ax = plt.gca()
+    q = map.quiver(x[points], y[points], np.ones(x[points].shape), np.zeros(x[points].shape), **ARROWSTYLE)
+    fig.canvas.draw()
+    width = int(round(fig.bbox.width))
+    height = int(round(fig.bbox.height))
+    bbox = ax.get_window_extent()
+    box = (int(round(bbox.x0)), height - int(round(bbox.y1)),
+           int(round(bbox.x1)), height - int(round(bbox.y0)))
+    inv = ax.transData.inverted()
+
+    # Mercator is separable: longitude by pixel column, latitude by row
+    colX = np.arange(box[0], box[2]) + 0.5
+    rowY = height - (np.arange(box[1], box[3]) + 0.5)
+    px = inv.transform(np.column_stack([colX, np.full(colX.size, rowY[0])]))[:, 0]
+    py = inv.transform(np.column_stack([np.full(rowY.size, colX[0]), rowY]))[:, 1]
+    colLons = map(px, np.full(px.size, py[0]), inverse=True)[0]
+    rowLats = map(np.full(py.size, px[0]), py, inverse=True)[1]
+
+    tails = ax.transData.transform(np.column_stack([x[points].ravel(), y[points].ravel()]))
+    arrowPixels = (np.floor(tails[:, 0]).astype(np.intp),
+                   height - 1 - np.floor(tails[:, 1]).astype(np.intp),
+                   points[0].ravel(), points[1].ravel())
+    scale = q.scale
+    plt.close(fig)
+
+    return fastRender.buildRenderer(lons, lats, colLons, rowLats, box, getBackground(), waveColors(),
+                                    0.07, 4., arrowPixels, arrowSprites(map, inv, box, scale, height), cells)
+
+def initRenderer(waveH, wDir, lons, lats, fast=None, mask=None):
+    # mask: sea mask of (time, cell) sea-cell data (see seaGrid.py)
+    global renderState
+
+    map = newBasemap()
+
+    X, Y = np.meshgrid(lons, lats)
     x, y = map(X, Y)
 
     # reduce arrows density (1 out of 15)
     yy = np.arange(0, y.shape[0], 15)
     xx = np.arange(0, x.shape[1], 15)
-    points = np.meshgrid(yy,xx)
+    points = tuple(np.meshgrid(yy,xx))
+    cells = None if mask is None else seaGrid.cellIndex(mask)
+
+    if FASTRENDER and fast is None:
+        fast = initFastRenderer(map, x, y, points, lons, lats, cells)
+
+    # everything but the data that shapes a frame
+    params = hashlib.sha1(repr((MAPEXTENT, RELIEFSCALE, FIGSIZE, FASTRENDER, fastRender.ARROWANGLES,
+                                sorted(ARROWSTYLE.items()), 'rainbow', 0.07, 4., 75)).encode())
+    params.update(np.ascontiguousarray(lons).tobytes())
+    params.update(np.ascontiguousarray(lats).tobytes())
+    if mask is not None:
+        # the color levels of a frame are those of its sea cells
+        params.update(np.packbits(mask).tobytes())
+
+    renderState = {'map': map, 'x': x, 'y': y, 'points': points, 'cells': cells,
+                   'waveH': waveH, 'wDir': wDir, 'background': getBackground(),
+                   'fast': fast, 'params': params}
+
+def initRenderWorker(settings, cacheDir, lons, lats, fast):
+    # workers memory-map the resampled cube instead of receiving it pickled
+    globals().update(settings)
+    myCMEMSdata = forecastCache.loadResampled(cacheDir, ('VHM0', 'VMDR'))
+    initRenderer(myCMEMSdata.VHM0.values, myCMEMSdata.VMDR.values, lons, lats, fast,
+                 seaGrid.maskOf(myCMEMSdata))
+
+def frameKey(i):
+    # the data as the frame shows it: wave height color levels and
+    # directions (whole degrees) at the arrows, plus the render parameters
+    points = renderState['points']
+    key = renderState['params'].copy()
+    key.update(fastRender.colorLevels(np.asarray(renderState['waveH'][i]), 0.07, 4.).tobytes())
+    wDir = seaGrid.field(renderState['wDir'][i], renderState['cells'], *points)
+    key.update(np.where(np.isfinite(wDir), np.rint(wDir), -1).astype(np.int16).tobytes())
+    return key.hexdigest()
+
+def renderFrame(i, filename):
+    outfile = TEMPDIR + filename + ".jpg"
+    cached = FRAMECACHEDIR + frameKey(i) + ".jpg"
+    if os.path.isfile(cached):
+        fileTools.linkFile(cached, outfile)
+        os.utime(cached)
+        return True
 
-    #cycle time to save maps
-    i=0
-    while i < myCMEMSdata.time.values.size:
-        fig=plt.figure(figsize=(20.48, 10.24))
-        map.shadedrelief(scale=0.65)
-        #waves height
-        waveH = myCMEMSdata.VHM0.values[i, :, :]
-        my_cmap = plt.get_cmap('rainbow')
-        map.pcolormesh(x, y, waveH, cmap=my_cmap, norm=matplotlib.colors.LogNorm(vmin=0.07, vmax=4.,clip=True))
-        # waves direction
-        wDir = myCMEMSdata.VMDR.values[i, :, :]
-        map.quiver(x[tuple(points)],y[tuple(points)],np.cos(np.deg2rad(270-wDir[tuple(points)])),np.sin(np.deg2rad(270-wDir[tuple(points)])),
-            edgecolor='lightgray', minshaft=4,  width=0.007, headwidth=3., headlength=4., linewidth=.5)
-        # save plot
-        filename = pd.to_datetime(myCMEMSdata.time[i].values).strftime("%Y-%m-%d_%H")
-        #plt.show()
-        plt.savefig(TEMPDIR+filename+".jpg", quality=75)
-        plt.clf()
-        del wDir
-        del waveH
-        del my_cmap
-        plt.close("all")
-        del fig
-        i += 1
-
-    #out of loop
-    del map
-    myCMEMSdata.close()
-    del myCMEMSdata
-    gc.collect()
+    # save to a hidden name, then rename: readers never see partial frames
+    tmpfile = TEMPDIR + "." + filename + ".jpg"
+    if renderState['fast'] is not None:
+        fastRender.renderJpeg(renderState['fast'], renderState['waveH'][i],
+                              renderState['wDir'][i], tmpfile, quality=75)
+    else:
+        plotFrame(i, tmpfile)
+    os.replace(tmpfile, outfile)
+
+    os.makedirs(FRAMECACHEDIR, exist_ok=True)
+    fileTools.linkFile(outfile, tmpfile)
+    os.replace(tmpfile, cached)
+    return False
+
+def pruneFrameCache():
+    limit = time.time() - FRAMECACHEDAYS * 86400
+    try:
+        entries = os.listdir(FRAMECACHEDIR)
+    except OSError:
+        return
+    for entry in entries:
+        if os.path.getmtime(FRAMECACHEDIR + entry) < limit:
+            os.remove(FRAMECACHEDIR + entry)
+
+def plotFrame(i, outfile):
+    # matplotlib/Basemap reference rendering
+    map = renderState['map']
+    x = renderState['x']
+    y = renderState['y']
+    points = renderState['points']
+
+    # composite on the cached relief: the map axes land on the same pixels
+    # it was rendered on, so only their own background must be hidden
+    fig=plt.figure(figsize=FIGSIZE)
+    fig.figimage(renderState['background'], origin='upper', zorder=-1)
+    plt.gca().patch.set_visible(False)
+    #waves height
+    waveH = seaGrid.field(renderState['waveH'][i], renderState['cells'])
+    my_cmap = plt.get_cmap('rainbow')
+    map.pcolormesh(x, y, waveH, cmap=my_cmap, norm=matplotlib.colors.LogNorm(vmin=0.07, vmax=4.,clip=True))
+    # waves direction
+    wDir = seaGrid.field(renderState['wDir'][i], renderState['cells'], *points)
+    map.quiver(x[points],y[points],np.cos(np.deg2rad(270-wDir)),np.sin(np.deg2rad(270-wDir)),
+        **ARROWSTYLE)
+    plt.savefig(outfile, pil_kwargs={'quality': 75})
+    plt.close(fig)
+
+def renderFrameTask(task):
+    # (seconds, reused from the frame cache)
+    start = time.time()
+    cached = renderFrame(*task)
+    return (time.time() - start, cached)
+
+def frameStats(record, results):
+    seconds = [r[0] for r in results]
+    record['frames'] = len(results)
+    record['cachedFrames'] = sum(1 for r in results if r[1])
+    record['frameMean'] = round(sum(seconds) / max(len(seconds), 1), 3)
+    record['frameMax'] = round(max(seconds, default=0.), 3)
+
+@instrument.timed("maps.getMaps")
+def getMaps(ncfile, workers=None):
+    if workers is None:
+        workers = MAPWORKERS
+    # resampled cube shared with getSpotsWindWaves.py through the cache
+    cacheDir = forecastCache.resampledDir(ncfile, downloadCache.checksumOf(ncfile))
+    myCMEMSdata = forecastCache.loadResampled(cacheDir, ('VHM0', 'VMDR'))
+
+    lons = myCMEMSdata.longitude.values
+    lats = myCMEMSdata.latitude.values
+    mask = seaGrid.maskOf(myCMEMSdata)
+    tasks = [(i, pd.to_datetime(t).strftime("%Y-%m-%d_%H"))
+             for i, t in enumerate(myCMEMSdata.time.values)]
+
+    if workers <= 1:
+        initRenderer(myCMEMSdata.VHM0.values, myCMEMSdata.VMDR.values, lons, lats, mask=mask)
+        with instrument.stage("maps.renderFrames") as record:
+            frameStats(record, [renderFrameTask(task) for task in tasks])
+        pruneFrameCache()
+        return
+
+    # render the background before starting the workers, so they find it
+    # on disk, and measure the fast renderer geometry once for all workers
+    getBackground()
+    fast = None
+    if FASTRENDER:
+        map = newBasemap()
+        X, Y = np.meshgrid(lons, lats)
+        x, y = map(X, Y)
+        points = tuple(np.meshgrid(np.arange(0, y.shape[0], 15), np.arange(0, x.shape[1], 15)))
+        fast = initFastRenderer(map, x, y, points, lons, lats, None if mask is None else seaGrid.cellIndex(mask))
+
+    # every worker memory-maps the same cached pages
+    with instrument.stage("maps.renderFrames") as record:
+        settings = {name: globals()[name] for name in WORKERSETTINGS}
+        with multiprocessing.get_context(STARTMETHOD).Pool(min(workers, len(tasks)) or 1,
+                                                           initializer=initRenderWorker,
+                                                           initargs=(settings, cacheDir, lons, lats, fast)) as pool:
+            frameStats(record, list(pool.imap_unordered(renderFrameTask, tasks)))
+    pruneFrameCache()
+
+@instrument.timed("maps.getTiles")
+def getTiles(ncfile, workers=None):
+    if workers is None:
+        workers = MAPWORKERS
+    cacheDir = forecastCache.resampledDir(ncfile, downloadCache.checksumOf(ncfile))
+    myCMEMSdata = forecastCache.loadResampled(cacheDir, ('VHM0',))
+    steps = [pd.to_datetime(t).strftime("%Y-%m-%d_%H") for t in myCMEMSdata.time.values]
+    mapTiles.renderTiles(cacheDir, steps, MAPEXTENT, waveColors(), 0.07, 4., TILETEMPDIR, workers,
+                         context=multiprocessing.get_context(STARTMETHOD))
 
 def mapsUpdated():
     try:
@@ -200,45 +466,53 @@ def mapsUpdated():
         return False
     return True
    
+@instrument.timed("maps.todayProductionUpdate")
 def todayProductionUpdate():
-    requestEndDateCoverage = subprocess.getoutput(
-        MOTUCLIENT + ' -s MEDSEA_ANALYSIS_FORECAST_WAV_006_017-TDS  -D -q -o console | grep "timeCoverage" ')
-
-    if 'msg="OK"' not in requestEndDateCoverage:
-        logging.warning('Processing MOTU EndDateCoverage request failed!')
-        send_notice_mail('Processing MOTU EndDateCoverage request failed!')
+    global endDate
+    # coverage end from the probe cache shared with getSpotsWindWaves.py
+    coverage = upstreamProbe.probe(MOTUCLIENT, SERVICE)['coverage']
+    if coverage['error']:
+        logging.warning('Processing MOTU EndDateCoverage request failed! ' + coverage['error'])
+        send_notice_mail('Processing MOTU EndDateCoverage request failed! ' + coverage['error'])
         return False
 
-    requestEndDateCoverage = requestEndDateCoverage.strip().replace('"', '')
-    b = requestEndDateCoverage.find('end=')+4
-    parsedDate = requestEndDateCoverage[b:b+10]
-
-    dateInterval = (datetime.strptime(
-        parsedDate, "%Y-%m-%d").date() - datetime.now().date()).days
-
-    if dateInterval >= 4:
+    endDate = coverage['value'][:10]
+    if upstreamProbe.coverageDays(coverage['value']) >= upstreamProbe.MINDAYS:
         return True
     else:
         logging.warning('Coverage date interval <4 days!')
         return False
 
 
+@instrument.timed("maps.moveFiles")
 def moveFiles():
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
-    shutil.rmtree(os.getcwd() + "/CMEMSmaps", ignore_errors=True)
-    shutil.move(TEMPDIR, os.getcwd())
+    fileTools.publishDir(TEMPDIR, path + "/CMEMSmaps")
 
-def ncFileDownloaded():
+def updateMaps():
+    # clear and restate temp dir
+    shutil.rmtree(TEMPDIR, ignore_errors=True)
     try:
-        ct = os.path.getctime(NC_FILE)
+        os.makedirs(TEMPDIR)
     except:
-        return False
-    fileCreated=datetime.fromtimestamp(ct)
-    diff = datetime.now() - fileCreated
-    if diff.days > 0:
-        return False
-    return True
+        pass
+
+    getMaps(NC_FILE)
+    forecastCache.logPeakMemory("Maps")
+    moveFiles()
+
+    if TILES:
+        shutil.rmtree(TILETEMPDIR, ignore_errors=True)
+        os.makedirs(TILETEMPDIR)
+        getTiles(NC_FILE)
+        forecastCache.logPeakMemory("Map tiles")
+        fileTools.publishDir(TILETEMPDIR, path + "/CMEMStiles")
 
+    # write update date/time
+    now = datetime.now()
+    now = now.strftime("%Y-%m-%d %H:%M")
+    g = open(path+'/CMEMS-update-maps.txt', 'w', encoding='utf-8')
+    g.write(now)
+    g.close()
 
 def send_notice_mail(text):
     from email.mime.text import MIMEText
@@ -267,6 +541,8 @@ def send_notice_mail(text):
 
 ###################################
 if __name__ == '__main__':
+    instrument.start("getWavesMaps")
+
     minLon = '-10'
     maxLon = "36.5"
     minLat = '30'
@@ -285,26 +561,10 @@ if __name__ == '__main__':
     logging.warning(
         "Checked Product update available. Proceeding with update.")
 
-    # get main CMEMS NC file
-    if ncFileDownloaded() == False:
-        if getNCFiles(minLat, minLon, maxLat, maxLon) == False:
-            sys.exit()
-
-    # clear and restate temp dir
-    shutil.rmtree(TEMPDIR, ignore_errors=True)
-    try:
-        os.makedirs(TEMPDIR)
-    except:
-        pass
-
-    getMaps(NC_FILE)
-    moveFiles()
+    # get main CMEMS NC file (from the download cache when available)
+    if getNCFiles(minLat, minLon, maxLat, maxLon) == False:
+        sys.exit()
 
-    # write update date/time
-    now = datetime.now()
-    now = now.strftime("%Y-%m-%d %H:%M")
-    g = open(path+'/CMEMS-update-maps.txt', 'w', encoding='utf-8')
-    g.write(now)
-    g.close()
+    updateMaps()
     logging.warning("Application completed")
     sys.exit()
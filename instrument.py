@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Stage timing and resource figures for the update jobs
+#
+#  (C) Copyright 2018-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Every stage run under stage() (or a function decorated with timed())
+# records its wall and CPU time (worker processes included once they are
+# reaped), the peak RSS so far and the bytes downloaded meanwhile. When the
+# job exits, the records are appended as JSON lines to
+# log/<job>-report.jsonl and, with PROMFILE set, written as a Prometheus
+# textfile-collector file.
+# Stages may run concurrently (runPipeline.py): CPU time and bytes are
+# process-wide, so concurrent stages share them.
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import resource
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+REPORTDIR = path + "/log/"
+# Prometheus textfile-collector output, e.g.
+# /var/lib/node_exporter/textfile_collector/copernicus.prom; None: disabled
+PROMFILE = None
+
+job = None
+runStart = None
+records = []
+transferred = 0
+lock = threading.Lock()
+
+
+def peakMemory():
+    # peak RSS in MB of this process and of its largest finished child
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6
+    return (own, children)
+
+
+def cpuTime():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def countBytes(nbytes):
+    # called by downloads.fetch() for every completed transfer
+    global transferred
+    with lock:
+        transferred += nbytes
+
+
+@contextmanager
+def stage(name):
+    # yields the record, callers may add their own figures to it
+    record = {'stage': name}
+    start = time.time()
+    cpu = cpuTime()
+    bytesBefore = transferred
+    try:
+        yield record
+        record['ok'] = True
+    except BaseException:
+        record['ok'] = False
+        raise
+    finally:
+        own, children = peakMemory()
+        record.update({'wall': round(time.time() - start, 3),
+                       'cpu': round(cpuTime() - cpu, 3),
+                       'peakRSS': round(max(own, children), 1),
+                       'bytes': transferred - bytesBefore})
+        with lock:
+            records.append(record)
+
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start(name):
+    # record the run of job name; the report is written at exit
+    global job, runStart
+    job = name
+    runStart = time.time()
+    atexit.register(writeReport)
+
+
+def promLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def writeProm(run):
+    # one series per stage name; repeated stages are summed
+    stages = {}
+    for record in run['stages']:
+        total = stages.setdefault(record['stage'], {'wall': 0., 'cpu': 0., 'peakRSS': 0., 'bytes': 0, 'ok': 1})
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        total['bytes'] += record['bytes']
+        total['peakRSS'] = max(total['peakRSS'], record['peakRSS'])
+        total['ok'] = min(total['ok'], int(record['ok']))
+    metrics = (('copernicus_stage_seconds', 'wall', "Wall time of the stage"),
+               ('copernicus_stage_cpu_seconds', 'cpu', "CPU time of the stage"),
+               ('copernicus_stage_peak_rss_megabytes', 'peakRSS', "Peak RSS at the end of the stage"),
+               ('copernicus_stage_bytes', 'bytes', "Bytes downloaded during the stage"),
+               ('copernicus_stage_ok', 'ok', "1 if the stage completed"))
+    jobLabel = promLabel(run['job'])
+    lines = []
+    for metric, field, text in metrics:
+        lines.append("# HELP %s %s" % (metric, text))
+        lines.append("# TYPE %s gauge" % metric)
+        for name, total in stages.items():
+            lines.append('%s{job="%s",stage="%s"} %s' % (metric, jobLabel, promLabel(name), float(total[field])))
+    lines.append("# HELP copernicus_run_timestamp_seconds End of the last run")
+    lines.append("# TYPE copernicus_run_timestamp_seconds gauge")
+    lines.append('copernicus_run_timestamp_seconds{job="%s"} %d' % (jobLabel, run['end']))
+    tmpfile = PROMFILE + "." + str(os.getpid())
+    with open(tmpfile, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmpfile, PROMFILE)
+
+
+def writeReport():
+    if job is None or not records:
+        return
+    run = datetime.fromtimestamp(runStart).strftime("%Y-%m-%dT%H:%M:%S")
+    try:
+        os.makedirs(REPORTDIR, exist_ok=True)
+        with open(REPORTDIR + job + "-report.jsonl", 'a') as f:
+            for record in records:
+                f.write(json.dumps(dict(record, job=job, run=run), sort_keys=True) + "\n")
+        if PROMFILE:
+            writeProm({'job': job, 'end': time.time(), 'stages': records})
+    except (OSError, IOError) as e:
+        logging.warning("Can't write the run report: " + str(e))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# XYZ web tile pyramid of the wave height maps
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Every time step is written as <outdir>/<YYYY-MM-DD_HH>/<z>/<x>/<y>.png,
+# standard Web Mercator tiles with transparent land/no-data, colored as
+# the JPEG maps. Tiles without any sea pixel are not written; a tile equal
+# to the same tile of the previous step is hard-linked to it instead of
+# being encoded and written again. Tiles are shared out among processes,
+# each one rendering its tiles for all time steps.
+
+import os
+import io
+import math
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+from PIL import Image
+import fastRender
+import seaGrid
+import fileTools
+import forecastCache
+
+
+TILESIZE = 256
+ZOOMS = range(3, 9)
+
+
+def tileX(lon, z):
+    return int(math.floor((lon + 180.) / 360. * (1 << z)))
+
+
+def tileY(lat, z):
+    lat = math.radians(lat)
+    return int(math.floor((1. - math.asinh(math.tan(lat)) / math.pi) / 2. * (1 << z)))
+
+
+def tilesCovering(extent, zooms=ZOOMS):
+    # (z, x, y) of every tile touching extent = (minLon, minLat, maxLon, maxLat)
+    tiles = []
+    for z in zooms:
+        last = (1 << z) - 1
+        for x in range(max(tileX(extent[0], z), 0), min(tileX(extent[2], z), last) + 1):
+            for y in range(max(tileY(extent[3], z), 0), min(tileY(extent[1], z), last) + 1):
+                tiles.append((z, x, y))
+    return tiles
+
+
+def tilePixels(z, x, y):
+    # longitude of each pixel column and latitude of each pixel row
+    n = TILESIZE * (1 << z)
+    px = x * TILESIZE + np.arange(TILESIZE) + 0.5
+    py = y * TILESIZE + np.arange(TILESIZE) + 0.5
+    lons = px / n * 360. - 180.
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * py / n))))
+    return lons, lats
+
+
+def initTileWorker(cacheDir, lutColors, vmin, vmax, outdir, steps):
+    global tileState
+    myCMEMSdata = forecastCache.loadResampled(cacheDir, ('VHM0',))
+    lut = np.zeros((len(lutColors) + 1, 4), dtype=np.uint8)
+    lut[:-1, :3] = lutColors
+    lut[:-1, 3] = 255
+    mask = seaGrid.maskOf(myCMEMSdata)
+    tileState = {'waveH': myCMEMSdata.VHM0.values,
+                 'cells': None if mask is None else seaGrid.cellIndex(mask),
+                 'lons': myCMEMSdata.longitude.values, 'lats': myCMEMSdata.latitude.values,
+                 'lut': lut, 'vmin': vmin, 'vmax': vmax, 'outdir': outdir, 'steps': steps}
+
+
+def renderTile(tile):
+    # all time steps of one tile; returns (written, linked, skipped, bytes)
+    z, x, y = tile
+    lut = tileState['lut']
+    n = len(lut) - 1
+    lons, lats = tilePixels(z, x, y)
+    cols = fastRender.axisLookup(tileState['lons'], lons)
+    rows = fastRender.axisLookup(tileState['lats'], lats)
+    inside = (cols >= 0).any() and (rows >= 0).any()
+
+    written = linked = skipped = nbytes = 0
+    previous = None
+    for i, step in enumerate(tileState['steps']):
+        if not inside:
+            skipped += 1
+            continue
+        # only the grid cells under the tile are colored
+        yy = rows[rows >= 0]
+        xx = cols[cols >= 0]
+        sub = seaGrid.field(tileState['waveH'][i], tileState['cells'],
+                            slice(yy.min(), yy.max() + 1), slice(xx.min(), xx.max() + 1))
+        levels = fastRender.colorLevels(sub, tileState['vmin'], tileState['vmax'], n)
+        levels = np.pad(levels, ((0, 1), (0, 1)), constant_values=n)
+        r = np.where(rows >= 0, rows - yy.min(), -1)
+        c = np.where(cols >= 0, cols - xx.min(), -1)
+        pixels = levels[r[:, np.newaxis], c[np.newaxis, :]]
+        if (pixels == n).all():
+            skipped += 1
+            previous = None
+            continue
+
+        tilefile = "%s%s/%d/%d/%d.png" % (tileState['outdir'], step, z, x, y)
+        os.makedirs(os.path.dirname(tilefile), exist_ok=True)
+        digest = hashlib.blake2b(pixels.tobytes(), digest_size=16).digest()
+        if previous is not None and previous[0] == digest:
+            fileTools.linkFile(previous[1], tilefile)
+            linked += 1
+            continue
+
+        buffer = io.BytesIO()
+        Image.fromarray(lut[pixels], 'RGBA').save(buffer, format='PNG')
+        with open(tilefile, 'wb') as f:
+            f.write(buffer.getvalue())
+        written += 1
+        nbytes += buffer.tell()
+        previous = (digest, tilefile)
+    return (written, linked, skipped, nbytes)
+
+
+def renderTiles(cacheDir, steps, extent, lutColors, vmin, vmax, outdir, workers, zooms=ZOOMS, context=None):
+    # steps: output directory name of each time step of the cached cube;
+    # context: multiprocessing context of the worker pool
+    tiles = tilesCovering(extent, zooms)
+    initargs = (cacheDir, lutColors, vmin, vmax, outdir, steps)
+    if workers <= 1:
+        initTileWorker(*initargs)
+        results = [renderTile(tile) for tile in tiles]
+    else:
+        with (context or multiprocessing).Pool(workers, initializer=initTileWorker, initargs=initargs) as pool:
+            results = pool.map(renderTile, tiles, chunksize=max(len(tiles) // (workers * 8), 1))
+    written, linked, skipped, nbytes = [sum(r[k] for r in results) for k in range(4)]
+    logging.warning("Map tiles: %d written (%.1f MB), %d unchanged linked, %d empty skipped"
+                    % (written, nbytes / 1e6, linked, skipped))
+    return (written, linked, skipped, nbytes)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# CMEMS extractions split into parallel MOTU sub-requests
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# MOTU prepares every request on the server before it can be downloaded and
+# serves each connection at a limited rate. A request is split into time
+# pieces of PARTDAYS days and LONPARTS longitude bands; up to CONCURRENCY
+# pieces are processed by motuclient and downloaded at the same time, each
+# one retried on its own. The parts are merged into one NC file with the
+# dimensions, variables, attributes and packed values the single request
+# returns: coordinate axes are the sorted union of the parts' axes, so
+# pieces sharing a boundary day or column are written once. The merge runs
+# in a child process:
+#
+#   ./motuPlanner.py <output file> <part file>...
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from urllib.error import URLError, HTTPError
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import netCDF4
+import instrument
+import downloads
+import downloadCache
+import forecastCache
+
+
+# days of each time piece (0: no time split)
+PARTDAYS = 3
+# longitude bands of the bbox
+LONPARTS = 1
+# pieces processed and downloaded at the same time
+CONCURRENCY = 4
+# attempts after a failed piece, RETRYWAIT seconds (times the attempt) apart
+RETRIES = 2
+RETRYWAIT = 30
+
+
+class MotuError(Exception):
+    # motuclient returned no download url; the message is its output
+    pass
+
+
+def formatNumber(value):
+    return format(value, '.10g')
+
+
+def plan(params, partDays=None, lonParts=None):
+    # pieces {'bbox', 'start', 'end'} covering the downloadCache request
+    partDays = PARTDAYS if partDays is None else partDays
+    lonParts = LONPARTS if lonParts is None else lonParts
+    minLon, minLat, maxLon, maxLat = params['bbox']
+
+    times = [(params['start'], params['end'])]
+    try:
+        start = datetime.strptime(params['start'], "%Y-%m-%d").date()
+        end = datetime.strptime(params['end'], "%Y-%m-%d").date()
+    except ValueError:
+        # not plain dates: no time split
+        start = end = None
+    if partDays > 0 and start is not None and (end - start).days > partDays:
+        times = []
+        day = start
+        while day < end:
+            last = min(day + timedelta(days=partDays), end)
+            times.append((day.isoformat(), last.isoformat()))
+            day = last
+
+    edges = np.linspace(minLon, maxLon, max(lonParts, 1) + 1)
+    bands = [(float(edges[k]), float(edges[k + 1])) for k in range(len(edges) - 1)]
+    bands[0] = (minLon, bands[0][1])
+    bands[-1] = (bands[-1][0], maxLon)
+    return [{'bbox': [lon0, minLat, lon1, maxLat], 'start': t0, 'end': t1}
+            for t0, t1 in times for lon0, lon1 in bands]
+
+
+def motuCommand(motuClient, service, piece, variables):
+    minLon, minLat, maxLon, maxLat = piece['bbox']
+    return (motuClient + ' -s ' + service + '  -x ' + formatNumber(minLon) + ' -X ' +
+            formatNumber(maxLon) + ' -y ' + formatNumber(minLat) + ' -Y ' + formatNumber(maxLat) +
+            ' -t ' + piece['start'] + ' -T ' + piece['end'] +
+            ''.join(' -v ' + name for name in variables) + ' -q -o console')
+
+
+def fetchPiece(motuClient, params, piece, partfile, name):
+    # process and download one piece, retrying both; raises the error of
+    # the last attempt
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            logging.warning(name + ": failed (" + str(error) + "), retrying")
+            time.sleep(RETRYWAIT * attempt)
+        requestUrl = subprocess.getoutput(motuCommand(motuClient, params['service'], piece,
+                                                      params['variables']))
+        if "http://" not in requestUrl:
+            error = MotuError(requestUrl)
+            continue
+        url = "http://" + requestUrl.split("http://")[1]
+        try:
+            return downloads.fetch(url, partfile, name)
+        except (HTTPError, URLError) as e:
+            logging.warning(name + ": can't download " + url)
+            error = e
+    raise error
+
+
+def axisOffset(axis, values):
+    # position of the part axis values inside the merged axis
+    k = int(np.nonzero(axis == values[0])[0][0])
+    if not np.array_equal(axis[k:k + len(values)], values):
+        raise ValueError("parts are not on the same grid")
+    return k
+
+
+def copyVariable(src, dst, offsets):
+    # the part variable into its place, a block of the first dimension at
+    # a time
+    index = [slice(offsets[d], offsets[d] + n) if d in offsets else slice(None)
+             for d, n in zip(src.dimensions, src.shape)]
+    if not index:
+        dst.assignValue(src.getValue())
+        return
+    first = src.shape[0]
+    rowBytes = src.dtype.itemsize * int(np.prod(src.shape[1:], dtype=np.int64))
+    block = forecastCache.chunkLength(rowBytes)
+    for a in range(0, first, block):
+        b = min(a + block, first)
+        start = index[0].start or 0
+        dst[(slice(start + a, start + b),) + tuple(index[1:])] = src[a:b]
+
+
+def variableOptions(var, unlimited):
+    # storage options of a variable of the first part; chunk sizes follow
+    # the dimensions of the piece, so the library picks them again
+    options = {}
+    fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+    if fill is not None:
+        options['fill_value'] = fill
+    filters = var.filters() if hasattr(var, 'filters') else None
+    if filters:
+        options['zlib'] = bool(filters.get('zlib'))
+        options['shuffle'] = bool(filters.get('shuffle'))
+        if filters.get('complevel'):
+            options['complevel'] = filters['complevel']
+    if var.chunking() == 'contiguous' and not set(var.dimensions) & unlimited:
+        options['contiguous'] = True
+    return options
+
+
+def merge(partfiles, outfile):
+    # one NC file from the parts of a request; packed values are copied as
+    # stored, everything but the coordinate axes comes from the first part
+    parts = [netCDF4.Dataset(f) for f in partfiles]
+    try:
+        for nc in parts:
+            nc.set_auto_maskandscale(False)
+        first = parts[0]
+        axes = {}
+        for name in first.dimensions:
+            if name not in first.variables:
+                continue
+            axis = np.unique(np.concatenate([np.asarray(nc.variables[name][:]) for nc in parts]))
+            values = np.asarray(first.variables[name][:])
+            if values.size > 1 and values[0] > values[-1]:
+                axis = axis[::-1]
+            axes[name] = axis
+
+        partfile = outfile + ".part"
+        with netCDF4.Dataset(partfile, 'w', format=first.data_model) as out:
+            out.setncatts({k: first.getncattr(k) for k in first.ncattrs()})
+            unlimited = set()
+            for name, dim in first.dimensions.items():
+                if dim.isunlimited():
+                    unlimited.add(name)
+                out.createDimension(name, None if dim.isunlimited() else
+                                    len(axes[name]) if name in axes else len(dim))
+            for name, var in first.variables.items():
+                dst = out.createVariable(name, var.dtype, var.dimensions, **variableOptions(var, unlimited))
+                dst.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+            out.set_auto_maskandscale(False)
+            for name, axis in axes.items():
+                out.variables[name][:] = axis
+
+            copied = set()
+            for nc in parts:
+                if not all(len(nc.dimensions[name]) for name in axes):
+                    # a piece past the data
+                    continue
+                offsets = {name: axisOffset(axes[name], np.asarray(nc.variables[name][:])) for name in axes}
+                for name, var in nc.variables.items():
+                    if name in axes or name in copied:
+                        continue
+                    copyVariable(var, out.variables[name], offsets)
+                    if not set(var.dimensions) & set(axes):
+                        # the same in every part
+                        copied.add(name)
+    finally:
+        for nc in parts:
+            nc.close()
+    os.replace(partfile, outfile)
+    return outfile
+
+
+def mergeChild(partfiles, outfile):
+    # merge() in a child process: HDF5 keeps the memory of the copies for
+    # itself, and netCDF4 calls are not thread safe (the NOAA update may run
+    # in another thread)
+    try:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), outfile] + partfiles)
+    except subprocess.CalledProcessError as e:
+        raise OSError("merging the MOTU pieces failed (exit code %d)" % e.returncode)
+
+
+def download(motuClient, params, name="CMEMS"):
+    # the NC file of the downloadCache request, downloaded in pieces and
+    # recorded in the cache; raises MotuError or HTTPError/URLError of a
+    # piece that failed all its attempts
+    pieces = plan(params)
+    ncfile = downloadCache.cacheFile(params)
+    workDir = tempfile.mkdtemp(prefix=".parts-", dir=downloadCache.CACHEDIR)
+    try:
+        partfiles = [workDir + "/part-%03d.nc" % k for k in range(len(pieces))]
+        logging.warning("MOTU request in %d pieces, %d at a time" % (len(pieces), CONCURRENCY))
+        with ThreadPoolExecutor(max_workers=max(min(CONCURRENCY, len(pieces)), 1)) as executor:
+            futures = [executor.submit(fetchPiece, motuClient, params, piece, partfile,
+                                       "%s %d/%d" % (name, k + 1, len(pieces)))
+                       for k, (piece, partfile) in enumerate(zip(pieces, partfiles))]
+            try:
+                for future in futures:
+                    future.result()
+            except (MotuError, HTTPError, URLError):
+                for future in futures:
+                    future.cancel()
+                raise
+        if len(pieces) == 1:
+            os.replace(partfiles[0], ncfile)
+        else:
+            with instrument.stage("motu.merge") as record:
+                record['pieces'] = len(pieces)
+                mergeChild(partfiles, ncfile)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return downloadCache.record(params, ncfile)
+
+
+###################################
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("usage: motuPlanner.py <output file> <part file>...")
+        sys.exit(1)
+    merge(sys.argv[2:], sys.argv[1])
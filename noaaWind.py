@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# NOAA wind (NCEP_Global_Best) download from ERDDAP, limited to a bbox
+#
+#  (C) Copyright 2018-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# The NOAA grid longitude runs 0..359.5. A bbox crossing Greenwich is split
+# into two griddap sub-requests (e.g. 350..359.5 and 0..36.5) which are
+# stitched into one contiguous -10..36.5 grid.
+#
+# Wind is kept in a persistent local store (STOREFILE): each run requests
+# only the time steps after the last ingested one, appends them and drops
+# the steps before today.
+
+import os
+import logging
+from datetime import datetime
+import xarray as xr
+import numpy as np
+import downloads
+
+
+ERDDAP = "https://coastwatch.pfeg.noaa.gov/erddap/griddap/NCEP_Global_Best"
+NOAAVARS = ('ugrd10m', 'vgrd10m')
+# last longitude of the 0..360 NOAA grid
+NOAAMAXLON = 359.5
+NOAASTEP = 0.5
+STOREFILE = os.path.dirname(os.path.abspath(__file__)) + "/data/noaaWind.nc"
+
+
+def lonBands(minLon, maxLon):
+    # -180..180 bbox -> list of (lon0, lon1) ranges on the 0..360 axis
+    minLon = float(minLon)
+    maxLon = float(maxLon)
+    if minLon >= 0:
+        return [(minLon, maxLon)]
+    if maxLon < 0:
+        return [(360 + minLon, 360 + maxLon)]
+    return [(360 + minLon, NOAAMAXLON), (0., maxLon)]
+
+
+def erddapQuery(startTime, endTime, minLat, maxLat, lon0, lon1, variables=NOAAVARS):
+    constraint = "[(%s):1:(%s)][(%g):1:(%g)][(%g):1:(%g)]" % (
+        startTime, endTime, float(minLat), float(maxLat), lon0, lon1)
+    return ERDDAP + ".nc?" + ",".join(v + constraint for v in variables)
+
+
+def stitchBands(files, outfile):
+    # one dataset with -180..180 ascending longitudes
+    parts = []
+    for f in files:
+        with xr.open_dataset(f) as ds:
+            ds = ds.load()
+        lon = ds.longitude.values
+        parts.append(ds.assign_coords(longitude=np.where(lon > 180, lon - 360, lon)))
+    stitched = xr.concat(parts, dim='longitude').sortby('longitude')
+    tmpfile = outfile + ".part"
+    stitched.to_netcdf(tmpfile)
+    os.replace(tmpfile, outfile)
+
+
+def fetchWind(startTime, endTime, minLat, minLon, maxLat, maxLon, outfile):
+    # download the bbox and store it in outfile, -180..180 longitudes;
+    # raises HTTPError/URLError as urlopen does
+    jobs = []
+    for k, (lon0, lon1) in enumerate(lonBands(minLon, maxLon)):
+        url = erddapQuery(startTime, endTime, minLat, maxLat, lon0, lon1)
+        jobs.append((url, outfile + ".band" + str(k), "NOAA band " + str(k)))
+    try:
+        downloads.fetchAll(jobs)
+        stitchBands([job[1] for job in jobs], outfile)
+    finally:
+        for job in jobs:
+            if os.path.isfile(job[1]):
+                os.remove(job[1])
+    return outfile
+
+
+def erddapTime(t):
+    return np.datetime_as_string(np.datetime64(t, 's')) + "Z"
+
+
+def sameBbox(ds, minLat, minLon, maxLat, maxLon):
+    return (abs(float(ds.latitude.min()) - float(minLat)) <= NOAASTEP and
+            abs(float(ds.latitude.max()) - float(maxLat)) <= NOAASTEP and
+            abs(float(ds.longitude.min()) - float(minLon)) <= NOAASTEP and
+            abs(float(ds.longitude.max()) - float(maxLon)) <= NOAASTEP)
+
+
+def readStore(storeFile, minLat, minLon, maxLat, maxLon):
+    # stored wind for the same bbox, or None
+    if not os.path.isfile(storeFile):
+        return None
+    try:
+        with xr.open_dataset(storeFile) as ds:
+            stored = ds.load()
+    except (OSError, IOError, ValueError, RuntimeError):
+        logging.warning("Unreadable NOAA wind store, rebuilding: " + storeFile)
+        return None
+    if not sameBbox(stored, minLat, minLon, maxLat, maxLon):
+        logging.warning("NOAA wind store bbox changed, rebuilding: " + storeFile)
+        return None
+    return stored
+
+
+def updateStore(endTime, minLat, minLon, maxLat, maxLon, storeFile=STOREFILE):
+    # bring the store up to endTime and return its path; the dataset has the
+    # same ugrd10m/vgrd10m (time, latitude, longitude) layout as fetchWind()
+    # output. Raises HTTPError/URLError as urlopen does
+    os.makedirs(os.path.dirname(storeFile), exist_ok=True)
+    today = np.datetime64(datetime.utcnow().date(), 'ns')
+    end = np.datetime64(endTime.rstrip('Z'), 'ns')
+    stored = readStore(storeFile, minLat, minLon, maxLat, maxLon)
+    if stored is not None:
+        # expired steps
+        stored = stored.sel(time=stored.time.values >= today)
+        if stored.time.size == 0:
+            stored = None
+
+    last = stored.time.values[-1] if stored is not None else None
+    if last is not None and last >= end:
+        logging.warning("NOAA wind store already up to " + erddapTime(last))
+        fresh = None
+    else:
+        newfile = storeFile + ".new"
+        fetchWind(erddapTime(last if last is not None else today), endTime,
+                  minLat, minLon, maxLat, maxLon, newfile)
+        with xr.open_dataset(newfile) as ds:
+            fresh = ds.load()
+        os.remove(newfile)
+        if last is not None:
+            fresh = fresh.sel(time=fresh.time.values > last)
+        logging.warning("NOAA wind store: " + str(fresh.time.size) + " new time steps")
+
+    parts = [ds for ds in (stored, fresh) if ds is not None and ds.time.size]
+    if not parts:
+        raise ValueError("no NOAA wind time steps from " + erddapTime(today))
+    merged = xr.concat(parts, dim='time') if len(parts) > 1 else parts[0]
+    merged.attrs['lastIngested'] = erddapTime(merged.time.values[-1])
+
+    tmpfile = storeFile + ".part"
+    merged.to_netcdf(tmpfile)
+    os.replace(tmpfile, storeFile)
+    return storeFile
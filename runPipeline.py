@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Single entry point for the daily update: spots forecasts and waves maps
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Checks the product coverage once, downloads one superset CMEMS file
+# (VHM0, VMDR, VTM10) plus NOAA wind, resamples it once and then runs
+# spot extraction and map rendering concurrently on the same data.
+# getSpotsWindWaves.py and getWavesMaps.py remain usable on their own.
+
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# configured before the job modules, whose own basicConfig() is then a no-op
+LOGFORMAT = '%(asctime)s - %(message)s'
+LOGFILE = path + "/log/" + 'runPipeline.log'
+logging.basicConfig(filename=LOGFILE, format=LOGFORMAT, level=logging.WARN)
+
+import forecastCache
+import instrument
+import downloadCache
+import getSpotsWindWaves as spots
+import getWavesMaps as maps
+
+
+###################################
+if __name__ == '__main__':
+    instrument.start("runPipeline")
+
+    minLon = '-10'
+    maxLon = "36.5"
+    minLat = '30'
+    maxLat = "46"
+
+    # Check what needs an update for today
+    spotsNeeded = spots.isDbUpdated() != True
+    mapsNeeded = maps.mapsUpdated() != True
+    if not spotsNeeded and not mapsNeeded:
+        sys.exit()
+    logging.warning("Update needed - spots: " + str(spotsNeeded) + ", maps: " + str(mapsNeeded))
+
+    # one coverage check for both jobs
+    if spots.todayProductionUpdate() == False:
+        sys.exit()
+    maps.endDate = spots.endDate
+    logging.warning(
+        "Checked Product update available. Proceeding with update.")
+
+    # one superset CMEMS file (and the NOAA wind) for both jobs
+    if spots.getNCFiles(minLat, minLon, maxLat, maxLon) == False:
+        sys.exit()
+    maps.NC_FILE = spots.NC_FILE
+
+    dbData = None
+    if spotsNeeded:
+        dbData = spots.readData()
+        if not dbData or not dbData[0]:
+            spotsNeeded = False
+
+    # resample once, before the stages memory-map it concurrently
+    forecastCache.resampledDir(spots.NC_FILE, downloadCache.checksumOf(spots.NC_FILE))
+
+    stages = []
+    if spotsNeeded:
+        stages.append(lambda: spots.updateSpots(dbData))
+    if mapsNeeded:
+        stages.append(maps.updateMaps)
+    with ThreadPoolExecutor(max_workers=len(stages) or 1) as executor:
+        for future in [executor.submit(stage) for stage in stages]:
+            future.result()
+
+    forecastCache.logPeakMemory("Pipeline")
+    logging.warning("Pipeline completed")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Sea-cell-only representation of the CMEMS grid
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Land cells are NaN at every time step, so a (time, lat, lon) variable is
+# kept as a (time, cell) array of the sea cells only, plus the (lat, lon)
+# sea mask. Cells are numbered in row-major order of the mask, so
+# cellIndex(mask)[y, x] is the column of grid cell (y, x), -1 on land.
+# The mask (finite at any time step) is built once per grid (axes) and kept
+# in the cache directory; data with sea values outside it is refused by
+# compress(), and the mask is then widened with the cells of that data.
+# field() reads a window or points of one time step from either
+# representation, so the readers need not care which one they got.
+
+import os
+import hashlib
+import logging
+import numpy as np
+
+
+# name of the sea cell dimension and of the mask coordinate
+CELLDIM = 'cell'
+MASKNAME = 'seamask'
+
+
+class LandMismatch(ValueError):
+    pass
+
+
+def gridHash(lats, lons):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(lats, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lons, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def maskFile(cacheDir, lats, lons):
+    return cacheDir + "seamask-" + gridHash(lats, lons) + ".npy"
+
+
+def buildMask(ds, names, blockBytes, mask=None):
+    # sea: finite at any time step in any of the variables, read blockBytes
+    # of time steps at a time; a given mask is widened
+    for name in names:
+        var = ds[name].transpose('time', 'latitude', 'longitude')
+        stepBytes = 2 * max(var.dtype.itemsize, 4) * var.shape[1] * var.shape[2]
+        steps = max(int(blockBytes // stepBytes), 1)
+        for a in range(0, var.shape[0], steps):
+            sea = np.isfinite(np.asarray(var[{'time': slice(a, a + steps)}].values)).any(axis=0)
+            mask = sea if mask is None else mask | sea
+    return mask
+
+
+def saveMask(cacheDir, ds, mask):
+    maskfile = maskFile(cacheDir, ds.latitude.values, ds.longitude.values)
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpfile = maskfile + "." + str(os.getpid()) + ".npy"
+    np.save(tmpfile, mask)
+    os.replace(tmpfile, maskfile)
+
+
+def gridMask(ds, names, cacheDir, blockBytes):
+    # the mask of the grid of ds, built on first use
+    maskfile = maskFile(cacheDir, ds.latitude.values, ds.longitude.values)
+    try:
+        mask = np.load(maskfile)
+        if mask.shape == (ds.sizes['latitude'], ds.sizes['longitude']):
+            return mask
+    except (OSError, IOError, ValueError):
+        pass
+    mask = buildMask(ds, names, blockBytes)
+    logging.warning("Sea mask: %d sea cells of %d" % (mask.sum(), mask.size))
+    saveMask(cacheDir, ds, mask)
+    return mask
+
+
+def widenMask(ds, names, cacheDir, blockBytes, mask):
+    # the mask of the grid with the sea cells of ds added, kept for the
+    # next runs
+    wider = buildMask(ds, names, blockBytes, mask)
+    logging.warning("Sea mask widened: %d sea cells of %d (were %d)" % (wider.sum(), wider.size, mask.sum()))
+    saveMask(cacheDir, ds, wider)
+    return wider
+
+
+def cellIndex(mask):
+    # (lat, lon) -> sea cell column, -1 on land
+    cells = np.full(mask.shape, -1, dtype=np.int32)
+    cells[mask] = np.arange(int(mask.sum()), dtype=np.int32)
+    return cells
+
+
+def compress(block, mask):
+    # (time, lat, lon) -> (time, cell); LandMismatch if a land cell has data.
+    # take() of flat indices keeps the result C-ordered, as the time means
+    # of forecastCache.binMean() need
+    block = block.reshape(block.shape[0], -1)
+    if np.isfinite(np.take(block, np.flatnonzero(~mask), axis=1)).any():
+        raise LandMismatch("sea values outside the sea mask")
+    return np.take(block, np.flatnonzero(mask), axis=1)
+
+
+def gather(values, cells):
+    # values of the sea cells at cells (any shape), NaN where cells is -1
+    values = np.asarray(values)
+    cells = np.asarray(cells)
+    out = values[..., np.maximum(cells, 0)]
+    if out.dtype.kind != 'f':
+        out = out.astype(np.float32)
+    out[..., cells < 0] = np.nan
+    return out
+
+
+def expand(values, mask):
+    # (..., cell) -> (..., lat, lon), NaN on land
+    return gather(values, cellIndex(mask))
+
+
+def maskOf(dataset):
+    # the sea mask of a sparse dataset, None for a full grid one
+    if MASKNAME not in dataset.coords:
+        return None
+    return np.asarray(dataset[MASKNAME].values, dtype=bool)
+
+
+def seaMask(dataset, name):
+    # sea cells of either representation
+    mask = maskOf(dataset)
+    if mask is not None:
+        return mask
+    return np.isfinite(np.asarray(dataset[name][0].values))
+
+
+def field(values, cells, y=slice(None), x=slice(None)):
+    # values[y, x] of one time step: a (lat, lon) step when cells is None,
+    # else a (cell) step read through cells = cellIndex(mask)
+    if cells is None:
+        return np.asarray(values[y, x])
+    return gather(values, cells[y, x])
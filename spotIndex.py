@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Persisted spot -> grid cell index tables
+#
+#  (C) Copyright 2018-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# The nearest grid cell of every spot is computed once per grid and kept in
+# cache/spotindex-<grid>.npz together with a hash of the spots (id, lat,
+# lon) and of the grid axes. The table is rebuilt only when either changes;
+# otherwise extraction is pure array indexing.
+# With SNAPTOSEA, a spot whose nearest cell is land (NaN) is moved to the
+# nearest sea cell of the grid.
+
+import os
+import hashlib
+import logging
+import numpy as np
+import spotsExtract
+import seaGrid
+
+
+CACHEDIR = os.path.dirname(os.path.abspath(__file__)) + "/cache/"
+# use the nearest sea cell when the nearest cell is land
+SNAPTOSEA = False
+
+
+def spotsHash(ids, lats, lons):
+    h = hashlib.sha1()
+    h.update("\n".join(str(i) for i in ids).encode())
+    h.update(np.asarray(lats, dtype=np.float64).tobytes())
+    h.update(np.asarray(lons, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def gridHash(dataset):
+    return seaGrid.gridHash(dataset.latitude.values, dataset.longitude.values)
+
+
+def snapToSea(sea, y, x):
+    # sea: (lat, lon) bool mask; land cells move to the nearest sea cell,
+    # by grid distance
+    y = y.copy()
+    x = x.copy()
+    land = np.nonzero(~sea[y, x])[0]
+    if land.size == 0:
+        return (y, x)
+    seaY, seaX = np.nonzero(sea)
+    if seaY.size == 0:
+        return (y, x)
+    for k in land:
+        nearest = np.argmin((seaY - y[k]) ** 2 + (seaX - x[k]) ** 2)
+        y[k] = seaY[nearest]
+        x[k] = seaX[nearest]
+    logging.warning("%d spots on land cells moved to the nearest sea cell" % land.size)
+    return (y, x)
+
+
+def lookup(grid, dataset, ids, lats, lons, seaVar=None):
+    # (y, x) grid cells of the spots; seaVar: variable whose NaN cells are
+    # land, used with SNAPTOSEA
+    snap = SNAPTOSEA and seaVar is not None
+    key = "%s-%s-%d" % (spotsHash(ids, lats, lons), gridHash(dataset), snap)
+    indexFile = CACHEDIR + "spotindex-" + grid + ".npz"
+    try:
+        with np.load(indexFile) as index:
+            if str(index['key']) == key:
+                return (index['y'], index['x'])
+    except (OSError, IOError, ValueError, KeyError):
+        pass
+
+    logging.warning("Building the " + grid + " spot index")
+    y, x = spotsExtract.gridIndexes(dataset, lats, lons)
+    if snap:
+        sea = seaGrid.seaMask(dataset, seaVar)
+        y, x = snapToSea(sea, y, x)
+
+    os.makedirs(CACHEDIR, exist_ok=True)
+    tmpfile = indexFile + "." + str(os.getpid()) + ".npz"
+    np.savez(tmpfile, key=key, y=y, x=x)
+    os.replace(tmpfile, indexFile)
+    return (y, x)
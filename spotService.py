@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# On-demand spot forecasts over HTTP
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Serves the same JSON documents getSpotsWindWaves.py writes into
+# CMEMS-NOAA/, computed on request from the day's resampled CMEMS cube
+# (memory-mapped from the forecastCache entry of the newest CMEMS download)
+# and the NOAA wind store:
+#   GET /spot/<id>               a spot of the spots table
+#   GET /spot/<lat>,<lon>        any position (nearest grid cell)
+#   GET /spots?ids=<id>,<id>...  {"<id>": document, ...}
+#   POST /spots                  same, body {"ids": [...]}
+# Encoded documents are kept in an LRU cache of CACHESIZE entries. Every
+# RELOAD seconds the sources are checked: when a new day's data is there,
+# it is loaded aside and swapped in, requests in flight finish on the old
+# data.
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+import urllib.parse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# configured before the job modules, whose own basicConfig() is then a no-op
+LOGFORMAT = '%(asctime)s - %(message)s'
+LOGFILE = path + "/log/" + 'spotService.log'
+if __name__ == '__main__':
+    logging.basicConfig(filename=LOGFILE, format=LOGFORMAT, level=logging.WARN)
+
+import numpy as np
+import xarray as xr
+import forecastCache
+import downloadCache
+import noaaWind
+import spotsDb
+import spotIndex
+import spotsExtract
+import spotsJson
+
+
+HOST = '127.0.0.1'
+PORT = 8088
+CACHESIZE = 10000
+# seconds between checks for new data
+RELOAD = 300
+# at most this many ids per batch request
+MAXBATCH = 5000
+NOAA_FILE = noaaWind.STOREFILE
+WAVEVARS = ('VHM0', 'VMDR', 'VTM10')
+POSITION = re.compile(r'^(-?\d+(?:\.\d*)?),(-?\d+(?:\.\d*)?)$')
+
+current = None
+reloadLock = threading.Lock()
+
+
+class NotFound(Exception):
+    pass
+
+
+def newestCMEMS():
+    # (file, checksum) of the newest cached CMEMS download with the spot
+    # variables, or None
+    entries = [e for e in downloadCache.readManifest().values()
+               if set(e['params']['variables']) >= set(WAVEVARS) and os.path.isfile(e['file'])]
+    if not entries:
+        return None
+    entry = max(entries, key=lambda e: e['created'])
+    return (entry['file'], entry['checksum'])
+
+
+def sourceVersion():
+    # changes whenever any source of the documents changes
+    cmems = newestCMEMS()
+    noaa = os.path.getmtime(NOAA_FILE) if os.path.isfile(NOAA_FILE) else None
+    return (cmems[1] if cmems else None, noaa)
+
+
+def loadState():
+    # everything a request needs, built aside from the one in service
+    version = sourceVersion()
+    cmems = newestCMEMS()
+    if cmems is None:
+        raise IOError("no CMEMS download in " + downloadCache.CACHEDIR)
+    waves = forecastCache.openResampled(cmems[0], WAVEVARS, checksum=cmems[1])
+    try:
+        with xr.open_dataset(NOAA_FILE) as ds:
+            wind = ds.load()
+    except (OSError, IOError, ValueError, RuntimeError) as e:
+        logging.warning("Spot service without wind data: " + str(e))
+        wind = None
+
+    ids, lats, lons = spotsDb.readSpots()
+    spotsDb.closeConnection()
+    rows = {str(id): k for k, id in enumerate(ids)}
+    waveCells = spotIndex.lookup('cmems', waves, ids, lats, lons, seaVar='VHM0')
+    windCells = spotIndex.lookup('noaa', wind, ids, lats, lons) if wind is not None else None
+    logging.warning("Spot service data loaded: %s, %d spots" % (cmems[0], len(ids)))
+    return {'version': version, 'waves': waves, 'wind': wind, 'ids': ids, 'lats': lats, 'lons': lons,
+            'rows': rows, 'waveCells': waveCells, 'windCells': windCells,
+            'timeTable': spotsJson.timeTable(waves.time.values),
+            'cache': OrderedDict(), 'lock': threading.Lock()}
+
+
+def reload(force=False):
+    # swap in new data when the sources changed; True if swapped
+    global current
+    with reloadLock:
+        if not force and current is not None and sourceVersion() == current['version']:
+            return False
+        current = loadState()
+        return True
+
+
+def encode(state, lats, lons, waveCells=None, windCells=None):
+    # documents of the given spots, as saveSpots() writes them
+    waves = spotsExtract.extractWaves(state['waves'], lats, lons, waveCells)
+    waves = (waves['VHM0'], waves['VMDR'], waves['VTM10'])
+    wind = (None, None)
+    if state['wind'] is not None:
+        wind = spotsExtract.extractWind(state['wind'], lats, lons, windCells)
+    return spotsJson.encodeSpots(state['timeTable'], waves, wind)
+
+
+def cached(state, key):
+    with state['lock']:
+        document = state['cache'].get(key)
+        if document is not None:
+            state['cache'].move_to_end(key)
+        return document
+
+
+def remember(state, key, document):
+    with state['lock']:
+        state['cache'][key] = document
+        state['cache'].move_to_end(key)
+        while len(state['cache']) > CACHESIZE:
+            state['cache'].popitem(last=False)
+
+
+def encodeRows(state, rows):
+    # documents of the spots at the given table rows
+    windCells = None
+    if state['windCells'] is not None:
+        windCells = (state['windCells'][0][rows], state['windCells'][1][rows])
+    return encode(state, state['lats'][rows], state['lons'][rows],
+                  (state['waveCells'][0][rows], state['waveCells'][1][rows]), windCells)
+
+
+def spotDocuments(state, ids):
+    # {id: document} of spots of the table, computed in one batch for the
+    # ones not cached; spots without a forecast (land, missing data) are
+    # left out; raises NotFound for unknown ids
+    documents = {}
+    missing = []
+    for id in ids:
+        if id not in state['rows']:
+            raise NotFound("unknown spot " + id)
+        document = cached(state, ('id', id))
+        if document is None:
+            missing.append(id)
+        else:
+            documents[id] = document
+    if missing:
+        rows = np.array([state['rows'][id] for id in missing])
+        try:
+            encoded = encodeRows(state, rows)
+        except ValueError:
+            # one spot without a forecast: encode them one by one
+            encoded = []
+            for k in range(rows.size):
+                try:
+                    encoded.extend(encodeRows(state, rows[k:k + 1]))
+                except ValueError:
+                    encoded.append(None)
+        for id, document in zip(missing, encoded):
+            if document is not None:
+                remember(state, ('id', id), document)
+                documents[id] = document
+    return documents
+
+
+def insideAxis(axis, value):
+    half = abs(float(axis[-1]) - float(axis[0])) / max(len(axis) - 1, 1) / 2
+    return min(axis[0], axis[-1]) - half <= value <= max(axis[0], axis[-1]) + half
+
+
+def positionDocument(state, lat, lon):
+    # any position; the cache key is the grid cell it falls in
+    grid = state['waves']
+    if not (insideAxis(grid.latitude.values, lat) and insideAxis(grid.longitude.values, lon)):
+        raise NotFound("%s,%s is outside the forecast grid" % (lat, lon))
+    lats = np.array([lat])
+    lons = np.array([lon])
+    waveCells = spotsExtract.gridIndexes(state['waves'], lats, lons)
+    windCells = None
+    if state['wind'] is not None:
+        windCells = spotsExtract.gridIndexes(state['wind'], lats, lons)
+    key = ('cell', int(waveCells[0][0]), int(waveCells[1][0]),
+           None if windCells is None else (int(windCells[0][0]), int(windCells[1][0])))
+    document = cached(state, key)
+    if document is None:
+        try:
+            document = encode(state, lats, lons, waveCells, windCells)[0]
+        except ValueError:
+            raise NotFound("no forecast at %s,%s" % (lat, lon))
+        remember(state, key, document)
+    return document
+
+
+def batchDocument(documents, ids):
+    # spots without a forecast are null
+    return b'{' + b','.join(json.dumps(id).encode() + b':' + documents.get(id, b'null').rstrip(b'\n')
+                            for id in ids) + b'}\n'
+
+
+class SpotHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body, contentType='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, text):
+        self.reply(code, (json.dumps({'error': text}) + "\n").encode())
+
+    def batch(self, state, ids):
+        if not ids or len(ids) > MAXBATCH:
+            return self.error(400, "between 1 and %d ids" % MAXBATCH)
+        self.reply(200, batchDocument(spotDocuments(state, ids), ids))
+
+    def handle_request(self, method):
+        state = current
+        if state is None:
+            return self.error(503, "no forecast data loaded")
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            if method == 'GET' and url.path.startswith('/spot/'):
+                key = urllib.parse.unquote(url.path[len('/spot/'):])
+                position = POSITION.match(key)
+                if position:
+                    lat, lon = float(position.group(1)), float(position.group(2))
+                    self.reply(200, positionDocument(state, lat, lon))
+                else:
+                    document = spotDocuments(state, [key]).get(key)
+                    if document is None:
+                        raise NotFound("no forecast for spot " + key)
+                    self.reply(200, document)
+            elif method == 'GET' and url.path == '/spots':
+                query = urllib.parse.parse_qs(url.query)
+                self.batch(state, [id for id in ",".join(query.get('ids', [])).split(",") if id])
+            elif method == 'POST' and url.path == '/spots':
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                self.batch(state, [str(id) for id in body['ids']])
+            else:
+                self.error(404, "not found")
+        except NotFound as e:
+            self.error(404, str(e))
+        except (ValueError, KeyError, TypeError) as e:
+            self.error(400, "bad request: " + str(e))
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+def watchSources(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            if reload():
+                logging.warning("Spot service switched to new data")
+        except Exception as e:
+            # keep serving the current data
+            logging.warning("Spot service reload failed: " + str(e))
+
+
+def makeServer(host=HOST, port=PORT, interval=RELOAD):
+    # load the data and return the server, not yet serving; port 0 picks a
+    # free one (server.server_address)
+    reload(force=True)
+    server = ThreadingHTTPServer((host, port), SpotHandler)
+    server.daemon_threads = True
+    if interval:
+        threading.Thread(target=watchSources, args=(interval,), daemon=True).start()
+    return server
+
+
+###################################
+if __name__ == '__main__':
+    try:
+        server = makeServer()
+    except (OSError, IOError, ValueError, spotsDb.DBERRORS) as e:
+        logging.warning("Spot service can't start: " + str(e))
+        sys.exit(1)
+    logging.warning("Spot service listening on %s:%d" % server.server_address)
+    server.serve_forever()
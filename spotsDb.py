@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Access to the MeteoSurf spots and service tables
+#
+#  (C) Copyright 2018-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# One connection is opened on first use and reused by every query of the
+# run. Spots are read with an explicit id/lat/lon query through a
+# server-side cursor, BATCHSIZE rows at a time, into the arrays the batch
+# extractor takes. Every successful read refreshes a local snapshot of the
+# spots, used when the database can't be reached (or always, with
+# SNAPSHOTONLY).
+# Any DB-API connection works: set connectionFactory, e.g. to
+# lambda: sqlite3.connect(dbfile), to run against a local SQLite copy.
+
+import os
+import sys
+import json
+import sqlite3
+import logging
+from datetime import datetime
+import numpy as np
+import pymysql
+import pymysql.cursors
+
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# positions of spot id, latitude and longitude in the rows of the spots
+# table; their names are looked up once, unless cfg.mysql['spotColumns']
+# gives them
+SPOTPOSITIONS = (5, 4, 3)
+BATCHSIZE = 5000
+SNAPSHOTFILE = path + '/cache/spots.json'
+# read the spots from the snapshot, without querying the database
+SNAPSHOTONLY = False
+DBERRORS = (pymysql.MySQLError, sqlite3.Error)
+
+connectionFactory = None
+connection = None
+columns = None
+
+
+class ColumnsError(ValueError):
+    pass
+
+
+def mysqlConfig():
+    sys.path.insert(0, path + '/db/')
+    import dbaseconfig as cfg
+    return cfg.mysql
+
+
+def defaultConnect():
+    conf = mysqlConfig()
+    return pymysql.connect(host=conf['host'], user=conf['user'],
+                           password=conf['passwd'], database=conf['db'])
+
+
+def getConnection():
+    # the shared connection, reconnected if the server dropped it
+    global connection
+    if connection is not None:
+        try:
+            if isinstance(connection, pymysql.connections.Connection):
+                connection.ping(reconnect=True)
+            return connection
+        except DBERRORS:
+            closeConnection()
+    connection = (connectionFactory or defaultConnect)()
+    return connection
+
+
+def closeConnection():
+    global connection
+    if connection is not None:
+        try:
+            connection.close()
+        except DBERRORS:
+            pass
+    connection = None
+
+
+def tableColumns(db):
+    # names of the spots table columns at SPOTPOSITIONS
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT * FROM spots LIMIT 0")
+        names = [d[0] for d in cursor.description]
+    finally:
+        cursor.close()
+    if len(names) <= max(SPOTPOSITIONS):
+        raise ColumnsError("spots table has %d columns (%s): set 'spotColumns': (id, lat, lon) "
+                           "in mysql of db/dbaseconfig.py" % (len(names), ", ".join(names)))
+    return tuple(names[k] for k in SPOTPOSITIONS)
+
+
+def spotColumns(db):
+    # (id, lat, lon) column names of the spots table
+    global columns
+    if columns is None:
+        configured = mysqlConfig().get('spotColumns') if connectionFactory is None else None
+        columns = tuple(configured) if configured else tableColumns(db)
+        logging.warning("Spots columns: %s, %s, %s" % columns)
+    return columns
+
+
+def streamingCursor(db):
+    # unbuffered on MySQL: rows arrive as they are fetched
+    if isinstance(db, pymysql.connections.Connection):
+        return db.cursor(pymysql.cursors.SSCursor)
+    return db.cursor()
+
+
+def iterSpots(batchSize=BATCHSIZE):
+    # (ids, lats, lons) batches straight from the spots table
+    db = getConnection()
+    names = spotColumns(db)
+    cursor = streamingCursor(db)
+    try:
+        cursor.execute("SELECT %s, %s, %s FROM spots" % names)
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                break
+            ids, lats, lons = zip(*rows)
+            yield (list(ids), np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64))
+    finally:
+        cursor.close()
+
+
+def saveSnapshot(spots, snapshotFile=None):
+    snapshotFile = snapshotFile or SNAPSHOTFILE
+    ids, lats, lons = spots
+    os.makedirs(os.path.dirname(snapshotFile), exist_ok=True)
+    tmpfile = snapshotFile + "." + str(os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump({'ids': ids, 'lats': lats.tolist(), 'lons': lons.tolist()}, f, default=str)
+    os.replace(tmpfile, snapshotFile)
+
+
+def loadSnapshot(snapshotFile=None):
+    with open(snapshotFile or SNAPSHOTFILE) as f:
+        snapshot = json.load(f)
+    return (snapshot['ids'], np.array(snapshot['lats'], dtype=np.float64),
+            np.array(snapshot['lons'], dtype=np.float64))
+
+
+def readSpots():
+    # (ids, lats, lons) of all spots; the snapshot is used when the
+    # database fails and raised errors are those of the database
+    if SNAPSHOTONLY:
+        return loadSnapshot()
+    try:
+        ids = []
+        lats = []
+        lons = []
+        for batchIds, batchLats, batchLons in iterSpots():
+            ids += batchIds
+            lats.append(batchLats)
+            lons.append(batchLons)
+    except DBERRORS as e:
+        closeConnection()
+        if not os.path.isfile(SNAPSHOTFILE):
+            raise
+        logging.warning("Spots read from the local snapshot: " + str(e))
+        return loadSnapshot()
+    spots = (ids, np.concatenate(lats) if lats else np.empty(0), np.concatenate(lons) if lons else np.empty(0))
+    saveSnapshot(spots)
+    return spots
+
+
+def lastUpdate():
+    # updatedOn of the service table as 'YYYY-MM-DD'
+    cursor = getConnection().cursor()
+    try:
+        cursor.execute("SELECT updatedOn FROM service")
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return None if row is None else str(row[0])[:10]
+
+
+def isUpdatedToday():
+    return lastUpdate() == datetime.now().date().strftime('%Y-%m-%d')
+
+
+def setUpdatedToday():
+    db = getConnection()
+    cursor = db.cursor()
+    try:
+        cursor.execute("UPDATE service SET updatedOn = CURRENT_DATE")
+        db.commit()
+    finally:
+        cursor.close()
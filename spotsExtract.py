@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Batch extraction of spot forecasts from CMEMS and NOAA gridded data
+#
+#  (C) Copyright 2018-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# All spots are resolved against the grid axes in one vectorized step and
+# every variable is gathered for every spot with fancy-indexed reads over
+# blocks of time steps, limited to the rows/columns holding spots, so lazily
+# opened or memory-mapped data is never loaded whole.
+# Results are (spots x time) cubes. Sea-cell datasets (see seaGrid.py) are
+# read at the sea cell of every spot, NaN for spots on land.
+
+import math
+import numpy as np
+import forecastCache
+import seaGrid
+
+
+KNOTS = 1.9438444924574
+
+
+def nearestIndex(axis, values):
+    # nearest index on a regular (monotonic) axis for every value,
+    # ties resolved toward the lower index as np.argmin() does
+    axis = np.asarray(axis, dtype=np.float64)
+    values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+    if axis.size == 1:
+        return np.zeros(values.shape, dtype=np.intp)
+
+    descending = axis[0] > axis[-1]
+    if descending:
+        axis = axis[::-1]
+
+    idx = np.searchsorted(axis, values)
+    idx = np.clip(idx, 1, axis.size - 1)
+    left = axis[idx - 1]
+    right = axis[idx]
+    if descending:
+        # on a descending axis argmin() favours the higher value on ties
+        idx = idx - ((values - left) < (right - values))
+        return axis.size - 1 - idx
+    idx = idx - ((values - left) <= (right - values))
+    return idx
+
+
+def gridIndexes(dataset, lats, lons):
+    y = nearestIndex(dataset.latitude.values, lats)
+    x = nearestIndex(dataset.longitude.values, lons)
+    return (y, x)
+
+
+def gatherSpots(dataset, varNames, y, x):
+    # (time, lat, lon)[:, y, x] -> (spots, time), read block by block
+    if len(y) == 0:
+        return {name: np.empty((0, dataset[name].shape[0]), dtype=dataset[name].dtype) for name in varNames}
+    mask = seaGrid.maskOf(dataset)
+    if mask is not None:
+        return gatherCells(dataset, varNames, seaGrid.cellIndex(mask)[y, x])
+    y0, y1 = int(y.min()), int(y.max()) + 1
+    x0, x1 = int(x.min()), int(x.max()) + 1
+    cubes = {}
+    for name in varNames:
+        var = dataset[name]
+        steps = var.shape[0]
+        block = forecastCache.chunkLength((y1 - y0) * (x1 - x0) * var.dtype.itemsize)
+        cube = None
+        for t in range(0, steps, block):
+            values = var[t:t + block, y0:y1, x0:x1].values[:, y - y0, x - x0]
+            if cube is None:
+                cube = np.empty((len(y), steps), dtype=values.dtype)
+            cube[:, t:t + block] = values.T
+        cubes[name] = cube
+    return cubes
+
+
+def gatherCells(dataset, varNames, cells):
+    # (time, cell)[:, cells] -> (spots, time); -1 cells are NaN
+    cubes = {}
+    for name in varNames:
+        var = dataset[name]
+        steps = var.shape[0]
+        block = forecastCache.chunkLength(len(cells) * 2 * var.dtype.itemsize)
+        cube = np.empty((len(cells), steps), dtype=np.result_type(var.dtype, np.float32))
+        for t in range(0, steps, block):
+            cube[:, t:t + block] = seaGrid.gather(var[t:t + block].values, cells).T
+        cubes[name] = cube
+    return cubes
+
+
+def extractWaves(dataset, lats, lons, cells=None):
+    # cells: precomputed (y, x) grid cells of the spots (see spotIndex.py)
+    y, x = cells if cells is not None else gridIndexes(dataset, lats, lons)
+    return gatherSpots(dataset, ('VHM0', 'VMDR', 'VTM10'), y, x)
+
+
+def extractWind(dataset, lats, lons, cells=None):
+    # the NOAA file is stitched to -180..180 longitudes (see noaaWind.py)
+    y, x = cells if cells is not None else gridIndexes(dataset, lats, lons)
+    cubes = gatherSpots(dataset, ('ugrd10m', 'vgrd10m'), y, x)
+    ugrd = cubes['ugrd10m']
+    vgrd = cubes['vgrd10m']
+
+    # wind intensity in knots
+    speed = np.sqrt(vgrd * vgrd + ugrd * ugrd) * KNOTS
+
+    # wind direction
+    direction = 270 - np.arctan2(vgrd, ugrd) * (180 / math.pi)
+    direction[direction > 360] -= 360
+    return (speed, direction)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Serialization of the spot forecast JSON files
+#
+#  (C) Copyright 2018-2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Each variable is formatted for all spots at once from its (spots x time)
+# cube with a single %-template, the shared time table is encoded once, and
+# every spot file is assembled from these byte pieces. Output is the same as
+# print(json.dumps(Data, separators=(',', ':'))): keys in the same order,
+# heights/periods/wind as "%.2f" strings, wave directions as int().
+# A digest of every spot document is kept between runs: files whose content
+# did not change are not rewritten, and the ids of those that did are
+# returned for the downstream sync.
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def jsonArrays(cube, fmt, quoted):
+    # (spots, time) -> JSON array text of every spot
+    cube = np.asarray(cube)
+    spots, steps = cube.shape
+    if steps == 0:
+        return [b'[]'] * spots
+    sep = '","' if quoted else ','
+    row = sep.join([fmt] * steps)
+    text = "\n".join([row] * spots) % tuple(cube.ravel().tolist())
+    if quoted:
+        return [('["' + line + '"]').encode() for line in text.split("\n")]
+    return [('[' + line + ']').encode() for line in text.split("\n")]
+
+
+def intArrays(cube):
+    # int() of every value, truncated toward zero
+    cube = np.asarray(cube)
+    if not np.isfinite(cube).all():
+        raise ValueError("cannot convert non-finite direction to integer")
+    return jsonArrays(cube.astype(np.int64), '%d', False)
+
+
+def timeTable(times):
+    # [[dates], [hours]] of the forecast steps
+    dt = pd.to_datetime(times)
+    return [[str(i.date()) for i in dt], [str(i.time())[0:2] for i in dt]]
+
+
+def encodeSpots(timeTable, waves, wind):
+    # JSON document of every spot, in the order of the cubes
+    waveH, waveD, waveP = waves
+    vel, direz = wind
+    spots = len(waveH)
+
+    timeJson = json.dumps(timeTable, separators=(',', ':')).encode()
+    heights = jsonArrays(waveH, '%.2f', True)
+    periods = jsonArrays(waveP, '%.2f', True)
+    directions = intArrays(waveD)
+    if vel is None:
+        missing = json.dumps(["n/a"] * 36, separators=(',', ':')).encode()
+        speeds = windDirs = [missing] * spots
+    else:
+        speeds = jsonArrays(vel, '%.2f', True)
+        windDirs = jsonArrays(direz, '%.2f', True)
+
+    return [b''.join((b'{"time":', timeJson, b',"waveHeight":', heights[k],
+                      b',"wavePeriod":', periods[k], b',"waveDir":', directions[k],
+                      b',"windSpeed":', speeds[k], b',"windDir":', windDirs[k], b'}\n'))
+            for k in range(spots)]
+
+
+def writeFile(filename, data):
+    # readers see the old file or the new one, never a partial write
+    tmpfile = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename) + ".tmp")
+    with open(tmpfile, 'wb') as f:
+        f.write(data)
+    os.replace(tmpfile, filename)
+
+
+def readDigests(digestFile):
+    try:
+        with open(digestFile) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+def writeChanged(outdir, ids, documents, digestFile):
+    # write the documents whose digest differs from the last run (or whose
+    # file is missing); returns the ids written
+    previous = readDigests(digestFile)
+    digests = {}
+    changed = []
+    for id, document in zip(ids, documents):
+        digest = hashlib.blake2b(document, digest_size=16).hexdigest()
+        digests[str(id)] = digest
+        filename = outdir + str(id) + ".json"
+        if previous.get(str(id)) == digest and os.path.isfile(filename):
+            continue
+        writeFile(filename, document)
+        changed.append(id)
+    os.makedirs(os.path.dirname(digestFile), exist_ok=True)
+    writeFile(digestFile, json.dumps(digests, separators=(',', ':')).encode())
+    return changed
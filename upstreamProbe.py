@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+#
+# Cached probe of the upstream products: CMEMS coverage and NOAA last time
+#
+#  (C) Copyright 2020 - Fabio Marzocca - marzoccafabio@gmail.com
+#
+#  License: GPL
+#
+# Both jobs poll from cron until the day's CMEMS product is published. The
+# answers of the MOTU coverage request (motuclient -D) and of the ERDDAP
+# time[last] query are kept in PROBEFILE, shared by the jobs, each with the
+# time of its next probe; until then every poll is answered from the file.
+# Stale answers are probed at the same time, under a lock, so jobs polling
+# together probe once.
+# A coverage far enough ahead is trusted for READYTTL (at most until
+# midnight). While the product is not published, probes back off from
+# BACKOFF to MAXBACKOFF; once a publication has been seen, nothing is asked
+# before PUBLISHMARGIN ahead of the time of day it was seen.
+
+import os
+import re
+import json
+import time
+import fcntl
+import logging
+import subprocess
+import http.client
+import urllib.request
+from urllib.error import URLError, HTTPError
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+import instrument
+import downloads
+
+
+PROBEFILE = "/tmp/CMEMSprobe.json"
+# days of coverage after today the jobs need
+MINDAYS = 4
+# seconds a ready coverage and the NOAA last time are trusted
+READYTTL = 6 * 3600
+NOAATTL = 3600
+# seconds to the next coverage probe while the product is not published,
+# doubled after every miss
+BACKOFF = 300
+MAXBACKOFF = 3600
+# seconds to the next probe after a failed one
+ERRORWAIT = 300
+# seconds before the usual publication time to start probing
+PUBLISHMARGIN = 1800
+PROBETIMEOUT = 300
+
+TIMECOVERAGE = re.compile(r'<timeCoverage\b([^>]*)>')
+ATTRIBUTE = re.compile(r'([\w:]+)\s*=\s*"([^"]*)"')
+
+
+class ProbeError(Exception):
+    pass
+
+
+def parseCoverage(output):
+    # end of the timeCoverage element of motuclient -D output
+    match = TIMECOVERAGE.search(output)
+    if not match:
+        raise ProbeError("no timeCoverage in the MOTU answer: " + output.strip()[-200:])
+    attrs = dict(ATTRIBUTE.findall(match.group(1)))
+    if attrs.get('msg') != 'OK' or 'end' not in attrs:
+        raise ProbeError("MOTU timeCoverage: " + match.group(0))
+    try:
+        datetime.strptime(attrs['end'][:10], "%Y-%m-%d")
+    except ValueError:
+        raise ProbeError("MOTU timeCoverage end: " + attrs['end'])
+    return attrs['end']
+
+
+def parseLastTime(text):
+    # the time column of an ERDDAP .json table
+    try:
+        table = json.loads(text)['table']
+        value = table['rows'][-1][table['columnNames'].index('time')]
+        datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise ProbeError("bad ERDDAP time[last] answer: " + str(e))
+    return value
+
+
+def probeCoverage(motuClient, service):
+    try:
+        result = subprocess.run(motuClient + ' -s ' + service + ' -D -q -o console', shell=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True, timeout=PROBETIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise ProbeError("MOTU coverage request timed out")
+    return parseCoverage(result.stdout)
+
+
+def probeLastTime(erddap):
+    try:
+        with urllib.request.urlopen(erddap + '.json?time[last]', timeout=downloads.TIMEOUT) as res:
+            return parseLastTime(res.read().decode('utf-8'))
+    except (HTTPError, URLError, OSError, http.client.HTTPException) as e:
+        # read timeouts and dropped connections too
+        raise ProbeError(str(getattr(e, 'reason', e)))
+
+
+def coverageDays(end, today=None):
+    # days from today to the coverage end
+    today = today or datetime.now().date()
+    return (datetime.strptime(end[:10], "%Y-%m-%d").date() - today).days
+
+
+def publishTime(entry, now):
+    # today's time to start probing, None until a publication was seen
+    if not entry.get('published'):
+        return None
+    seen = datetime.fromtimestamp(entry['published']).time()
+    return datetime.combine(datetime.fromtimestamp(now).date(), seen).timestamp() - PUBLISHMARGIN
+
+
+def scheduleCoverage(entry, previous, now):
+    today = datetime.fromtimestamp(now).date()
+    if coverageDays(entry['value'], today) >= MINDAYS:
+        midnight = datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+        entry['misses'] = 0
+        entry['next'] = min(now + READYTTL, midnight)
+        return
+    start = publishTime(entry, now)
+    if start is not None and now < start:
+        entry['misses'] = 0
+        entry['next'] = start
+        return
+    misses = entry.get('misses', 0)
+    if start is not None and previous.get('checked', 0) < start:
+        # first probe of today's publication window
+        misses = 0
+    entry['misses'] = misses + 1
+    entry['next'] = now + min(BACKOFF * 2 ** misses, MAXBACKOFF)
+
+
+def updateEntry(name, previous, value, error, now):
+    # previous entry updated with a probe answer; a failed probe keeps the
+    # last value
+    entry = dict(previous)
+    entry.update({'error': error, 'checked': now})
+    if error:
+        entry.setdefault('value', None)
+        entry['next'] = now + ERRORWAIT
+        return entry
+    entry['value'] = value
+    if name == 'noaa':
+        entry['next'] = now + NOAATTL
+        return entry
+    if previous.get('value') and value > previous['value']:
+        entry['published'] = now
+    scheduleCoverage(entry, previous, now)
+    return entry
+
+
+@contextmanager
+def probeLock():
+    os.makedirs(os.path.dirname(PROBEFILE), exist_ok=True)
+    with open(PROBEFILE + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def readState():
+    try:
+        with open(PROBEFILE) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+def writeState(state):
+    tmpfile = PROBEFILE + "." + str(os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmpfile, PROBEFILE)
+
+
+def attempt(task):
+    try:
+        return (task(), None)
+    except ProbeError as e:
+        return (None, str(e))
+
+
+def probe(motuClient=None, service=None, erddap=None):
+    # {'coverage': entry} of the MOTU service and {'noaa': entry} of the
+    # ERDDAP dataset, for those given; entry: {'value', 'error', 'checked',
+    # 'next', ...}, 'value' the coverage end or NOAA last time (None if
+    # never probed successfully), 'error' the failure of the last probe
+    checks = {}
+    if service:
+        checks['coverage'] = ('motu:' + service, lambda: probeCoverage(motuClient, service))
+    if erddap:
+        checks['noaa'] = ('erddap:' + erddap, lambda: probeLastTime(erddap))
+
+    with probeLock():
+        state = readState()
+        now = time.time()
+        stale = [name for name, (key, task) in checks.items() if now >= state.get(key, {}).get('next', 0)]
+        if stale:
+            with instrument.stage("probe") as record:
+                record['probes'] = len(stale)
+                answers = downloads.runParallel([lambda task=checks[name][1]: attempt(task) for name in stale])
+            now = time.time()
+            for name, (value, error) in zip(stale, answers):
+                key = checks[name][0]
+                state[key] = updateEntry(name, state.get(key, {}), value, error, now)
+                logging.warning("Probe %s: %s, next probe at %s" % (
+                    key, error or value, datetime.fromtimestamp(state[key]['next']).strftime("%H:%M")))
+            writeState(state)
+    return {name: state[key] for name, (key, task) in checks.items()}